@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import vapoursynth as vs
+from rich.progress import Progress
+
+import comp
+
+core = vs.core
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss() -> Optional[int]:
+    """Peak resident set size of this process in bytes, or None where it can't be read."""
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def commit_hash() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def gradient(width: int, height: int, length: int, low: int, high: int) -> vs.VideoNode:
+    """Horizontal luma gradient from `low` to `high`, made by resizing a clip that is 2 pixels wide."""
+    left = core.std.BlankClip(width=1, height=1, format=vs.YUV444P8, length=length, color=[low, 128, 128])
+    right = core.std.BlankClip(width=1, height=1, format=vs.YUV444P8, length=length, color=[high, 128, 128])
+    return core.std.StackHorizontal([left, right]).resize.Bilinear(width, height, format=vs.YUV420P8)
+
+
+def synthetic_clip(width: int, height: int, length: int, segments: int = 8, noise: float = 0) -> vs.VideoNode:
+    """
+    Clip made of `segments` gradients that go from dark to bright and back,
+    so there are dark, bright and motion frames to select.
+    Noise is added with AddGrain if `noise` is above 0 and the plugin is installed.
+    """
+    levels = [(16, 60), (40, 100), (90, 160), (140, 220), (120, 200), (60, 140), (30, 90), (16, 40)]
+    segment_length = max(1, length // segments)
+
+    clip = core.std.Splice([
+        gradient(width, height, segment_length, *levels[i % len(levels)])
+        for i in range(segments)
+    ])
+    if clip.num_frames < length:
+        clip = clip + gradient(width, height, length - clip.num_frames, *levels[0])
+
+    if noise > 0:
+        if hasattr(core, 'grain'):
+            clip = core.grain.Add(clip, var=noise, constant=False)
+        else:
+            print('AddGrain is not installed, no noise is added.', file=sys.stderr)
+
+    return clip.std.AssumeFPS(fpsnum=24000, fpsden=1001).std.SetFrameProps(_Matrix=1)
+
+
+def timed(func: Callable[[], Any]) -> tuple[Any, float]:
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def render(clip: vs.VideoNode, frames: List[int]) -> None:
+    comp.render_screens([clip], frames, None, None, [None], on_frame=lambda i, num, frame: None)
+
+
+def stage(name: str, frames: int, build: float, run: float, baseline: Optional[int]) -> Dict[str, Any]:
+    peak = peak_rss()
+    return {
+        'stage': name,
+        'frames': frames,
+        'graph_build_s': round(build, 6),
+        'run_s': round(run, 6),
+        'fps': round(frames / run, 3) if run > 0 else None,
+        'peak_rss_bytes': peak,
+        'baseline_rss_bytes': baseline,
+        'peak_rss_delta_bytes': peak - baseline if peak is not None and baseline is not None else None,
+    }
+
+
+def isolated_stage(args: argparse.Namespace, name: str) -> List[Dict[str, Any]]:
+    """Run one stage in a fresh process, so its peak RSS isn't raised by the stages before it."""
+    with tempfile.TemporaryDirectory() as folder:
+        output = os.path.join(folder, 'stage.json')
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--in-process', '--stages', name, '--output', output,
+                        '--width', str(args.width), '--height', str(args.height), '--length', str(args.length),
+                        '--noise', str(args.noise), '--screens', str(args.screens), '--dark', str(args.dark),
+                        '--bright', str(args.bright), '--motion', str(args.motion)],
+                       stdout=subprocess.DEVNULL, check=True)
+        with open(output) as f:
+            return json.load(f)['stages']
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Time the frame selection and screenshot paths of comp.py on synthetic clips, and print the results as JSON.')
+    parser.add_argument('--width', '-W', dest='width', type=int, default=1920,
+                        help='Width of the synthetic clip')
+    parser.add_argument('--height', '-H', dest='height', type=int, default=1080,
+                        help='Height of the synthetic clip')
+    parser.add_argument('--length', '-l', dest='length', type=int, default=2400,
+                        help='Number of frames of the synthetic clip')
+    parser.add_argument('--noise', '-n', dest='noise', type=float, default=0,
+                        help='Variance of the noise added to the clip, needs AddGrain')
+    parser.add_argument('--screens', '-s', dest='screens', type=int, default=20,
+                        help='Number of frames to take screenshots of')
+    parser.add_argument('--dark', dest='dark', type=int, default=20,
+                        help='Number of dark frames to select')
+    parser.add_argument('--bright', dest='bright', type=int, default=10,
+                        help='Number of bright frames to select')
+    parser.add_argument('--motion', dest='motion', type=int, default=10,
+                        help='Number of motion frames to select')
+    parser.add_argument('--stages', dest='stages', type=str, default='lazylist,dedupe,get_frames,screengen,ffmpeg',
+                        help='Comma separated stages to run')
+    parser.add_argument('--output', '-o', dest='output', type=str, default=None,
+                        help='Write the results to this file instead of printing them')
+    parser.add_argument('--in-process', dest='in_process', action='store_true',
+                        help='Run all stages in this process instead of one fresh process per stage. The peak RSS of a '
+                             'stage then includes the stages before it, and its delta only shows how far the stage raised it')
+    args = parser.parse_args()
+
+    stages = [s.strip() for s in args.stages.lower().split(',') if s.strip() != '']
+
+    clip, build = timed(lambda: synthetic_clip(args.width, args.height, args.length, noise=args.noise))
+    step = max(1, clip.num_frames // max(1, args.screens))
+    frames = list(range(0, clip.num_frames, step))[:args.screens]
+
+    results = []
+
+    if not args.in_process:
+        for name in stages:
+            results.extend(isolated_stage(args, name))
+        stages = []
+
+    if 'lazylist' in stages:
+        baseline = peak_rss()
+        selected, run = timed(lambda: comp.lazylist(clip, args.dark, args.bright, args.motion))
+        results.append(stage('lazylist', clip.num_frames, 0, run, baseline) | {'selected': len(selected)})
+
+    if 'dedupe' in stages:
+        baseline = peak_rss()
+        framelist = list(range(clip.num_frames))
+        _, run = timed(lambda: comp.dedupe(clip, framelist, args.dark + args.bright, comp.screen_separation, comp.random_seed))
+        results.append(stage('dedupe', len(framelist), 0, run, baseline))
+
+    if 'get_frames' in stages:
+        baseline = peak_rss()
+        selection, build_time = timed(lambda: comp.get_frames(clip, frames))
+        _, run = timed(lambda: render(selection, list(range(selection.num_frames))))
+        results.append(stage('get_frames', len(frames), build_time, run, baseline))
+
+    # screengen expects a folder relative to the working directory
+    with tempfile.TemporaryDirectory(dir='.') as folder:
+        folder = os.path.relpath(folder)
+
+        if 'screengen' in stages:
+            baseline = peak_rss()
+            with Progress(disable=True) as progress:
+                total = progress.add_task('total', total=len(frames))
+                task = progress.add_task('screengen', total=len(frames))
+                _, run = timed(lambda: comp.screengen(progress, total, task, clip, folder, 'screengen', frames))
+            results.append(stage('screengen', len(frames), 0, run, baseline))
+
+        if 'ffmpeg' in stages:
+            if shutil.which('ffmpeg') is None:
+                print('ffmpeg is not installed, skipping the ffmpeg stage.', file=sys.stderr)
+            else:
+                baseline = peak_rss()
+                with Progress(disable=True) as progress:
+                    total = progress.add_task('total', total=len(frames))
+                    task = progress.add_task('ffmpeg', total=len(frames))
+                    selection, build_time = timed(lambda: comp.get_frames(
+                        clip.resize.Spline36(format=vs.RGB24, matrix_in=1, dither_type='error_diffusion'), frames))
+                    _, run = timed(lambda: comp.ffmpeg_screens(selection, frames, folder, 'ffmpeg', progress, total, task))
+                results.append(stage('ffmpeg', len(frames), build_time, run, baseline))
+
+    report = {
+        'commit': commit_hash(),
+        'python': platform.python_version(),
+        'vapoursynth': core.version_number(),
+        'threads': core.num_threads,
+        # How peak_rss_bytes was measured, see --in-process
+        'peak_rss': 'whole process' if args.in_process else 'process per stage',
+        'clip': {'width': args.width, 'height': args.height, 'length': clip.num_frames, 'noise': args.noise,
+                 'graph_build_s': round(build, 6)},
+        'stages': results,
+    }
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
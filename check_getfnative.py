@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import argparse
+import math
+import os
+import sys
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+
+import getfnative
+
+
+def check(name: str, passed: bool, failures: List[str]) -> None:
+    print(f'{"ok    " if passed else "FAILED"} {name}')
+    if not passed:
+        failures.append(name)
+
+
+def default_heights(base_height: int, step: float = 0.25) -> list[float]:
+    # Same range as getfnative's main without --min-src-height and --max-src-height
+    return [base_height - 100 + n * step for n in range(math.floor(100 / step) + 1)]
+
+
+def axis_keys(width: int, height: int, src_height: float) -> list[tuple]:
+    # Factorization keys of both axes of one height, as numpy_descale_error builds them
+    args = getfnative.descale_cropping_args(getfnative.SimpleNamespace(width=width, height=height),
+                                            src_height, height, width)
+    return [getfnative.factorization_key('bicubic', 0, 1 / 2, 3, args['height'], height, args['src_top'], args['src_height']),
+            getfnative.factorization_key('bicubic', 0, 1 / 2, 3, args['width'], width, args['src_left'], args['src_width'])]
+
+
+def factorizations(width: int, height: int, src_heights: list[float]) -> list:
+    return [getfnative.cached_weights(key)[2] for src_height in src_heights for key in axis_keys(width, height, src_height)]
+
+
+def upscaled_frame(width: int, height: int, src_height: float) -> np.ndarray:
+    # Random frame upscaled from `src_height` with the same weights the descale uses
+    keys = axis_keys(width, height, src_height)
+    matrices = [getfnative.weights_matrix(*getfnative.cached_weights(key)[:2], key[2]) for key in keys]
+    rng = np.random.default_rng(0)
+    native = rng.random((keys[0][2], keys[1][2]), dtype=np.float32)
+    return (matrices[0] @ (matrices[1] @ native.T).T).astype(np.float32)
+
+
+def check_default_range(width: int, height: int, failures: List[str]) -> None:
+    src_heights = default_heights(height)
+    native_height = src_heights[len(src_heights) // 3]
+    frame = upscaled_frame(width, height, native_height)
+
+    try:
+        errors = getfnative.numpy_errors({0: frame}, [(0, src_height) for src_height in src_heights],
+                                         base_height=height, base_width=width)
+        finite = all(math.isfinite(error) for error in errors)
+    except Exception as e:
+        print(f'{type(e).__name__}: {e}')
+        errors, finite = [], False
+    check(f'numpy engine gives a finite error for every height of the default {height}p range', finite, failures)
+    check(f'numpy engine finds the native height {native_height} in the default {height}p range',
+          finite and src_heights[int(np.argmin(errors))] == native_height and min(errors) == 0, failures)
+
+    if getfnative.cholesky_banded is not None:
+        scipy_factors = factorizations(width, height, src_heights)
+        getfnative.cached_weights.cache_clear()
+        cholesky_banded = getfnative.cholesky_banded
+        getfnative.cholesky_banded = None
+        try:
+            numpy_factors = factorizations(width, height, src_heights)
+        finally:
+            getfnative.cholesky_banded = cholesky_banded
+            getfnative.cached_weights.cache_clear()
+        check(f'NumPy fallback factorizes every height of the default {height}p range like SciPy',
+              all(a is not None and b is not None and np.allclose(a, b, rtol=1e-3, atol=1e-6)
+                  for a, b in zip(scipy_factors, numpy_factors)), failures)
+
+
+def sharp_curve(rng: np.random.Generator,
+                num_samples: int,
+                coarse_stride: int,
+                dips: int
+                ) -> tuple[np.ndarray, list[int]]:
+    # Slightly noisy log-scale background with V-shaped dips, each only as wide as the coarse step on either side
+    # and at least three coarse steps away from the others
+    curve = 1e-3 * (1 + 0.01 * rng.random(num_samples)) * np.exp(np.linspace(0, rng.uniform(-1, 1), num_samples))
+    centers = []
+    while len(centers) < dips:
+        center = int(rng.integers(0, num_samples))
+        if all(abs(center - other) >= 3 * coarse_stride for other in centers):
+            centers.append(center)
+    for center in centers:
+        distance = np.abs(np.arange(num_samples) - center)
+        depth = rng.uniform(0.5, 0.999)
+        curve *= np.where(distance < coarse_stride, 1 - depth * (1 - distance / coarse_stride), 1)
+    return curve, centers
+
+
+def check_adaptive_search(curves: int, failures: List[str]) -> None:
+    rng = np.random.default_rng(0)
+    num_samples = len(default_heights(1080))
+    mismatches = 0
+    evaluated = 0
+    for _ in range(curves):
+        coarse_stride = int(rng.integers(2, 9))
+        curve, centers = sharp_curve(rng, num_samples, coarse_stride, int(rng.integers(1, 6)))
+        adaptive = getfnative.adaptive_search(lambda indices: [curve[n] for n in indices], num_samples, coarse_stride)
+        evaluated += len(adaptive)
+        minima = getfnative.local_minima(adaptive)
+        if minima[0] != int(np.argmin(curve)) or not set(centers) <= set(minima):
+            mismatches += 1
+    print(f'       {evaluated / curves:.0f} of {num_samples} samples evaluated on average')
+    check(f'adaptive search finds the minimum and every dip of the exhaustive sweep on {curves} sharp curves',
+          mismatches == 0, failures)
+
+
+def check_weights_cache(failures: List[str]) -> None:
+    keys = [key for src_height in default_heights(540)[:40] for key in axis_keys(960, 540, src_height)]
+    with tempfile.TemporaryDirectory() as folder:
+        getfnative.weights_cache_dir = folder
+        getfnative.weights_cache_usage = None
+        try:
+            getfnative.cached_weights(keys[0])
+            entry_size = sum(entry.stat().st_size for entry in os.scandir(folder))
+            getfnative.weights_cache_limit = 10 * entry_size
+            for key in keys[1:]:
+                getfnative.cached_weights.cache_clear()
+                # the first entry is used again and again, so it should never be evicted
+                getfnative.cached_weights(keys[0])
+                getfnative.cached_weights(key)
+                time.sleep(0.01)
+            getfnative.cached_weights.cache_clear()
+            size = sum(entry.stat().st_size for entry in os.scandir(folder))
+            # read from disk if it's still there, a miss would write it again and add to the usage
+            first = getfnative.weights_cache_usage
+            getfnative.cached_weights(keys[0])
+            check('weights cache stays under its size limit', size <= getfnative.weights_cache_limit, failures)
+            check('weights cache keeps the recently used weights', getfnative.weights_cache_usage == first, failures)
+        finally:
+            getfnative.weights_cache_dir = None
+            getfnative.cached_weights.cache_clear()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Check the NumPy engine of getfnative.py over the default range of heights, '
+                    'and the adaptive search against the exhaustive sweep.')
+    parser.add_argument('--base-height', '-bh', dest='bh', type=int, default=1080,
+                        help='Height of the synthetic frame, the range checked ends at it')
+    parser.add_argument('--base-width', '-bw', dest='bw', type=int, default=1920,
+                        help='Width of the synthetic frame')
+    parser.add_argument('--curves', '-c', dest='curves', type=int, default=1000,
+                        help='Number of synthetic error curves for the adaptive search')
+    args = parser.parse_args()
+
+    # Nothing from earlier runs
+    getfnative.weights_cache_dir = None
+
+    failures = []
+    check_adaptive_search(args.curves, failures)
+    check_weights_cache(failures)
+    check_default_range(args.bw, args.bh, failures)
+
+    if failures:
+        sys.exit(f'{len(failures)} check(s) failed.')
+    print('All checks passed.')
+
+
+if __name__ == '__main__':
+    main()
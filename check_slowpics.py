@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import argparse
+import collections
+import json
+import os
+import sys
+import tempfile
+import threading
+import uuid
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List
+
+import comp
+
+
+class StandIn:
+    """
+    What the stand-in server has seen.
+    The first request to every endpoint, and the first upload of every image, gets a 503 back.
+    Uploads of the images in `rejected` always get a 400 back.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.requests: Dict[str, int] = collections.Counter()
+        self.image_tries: Dict[str, int] = collections.Counter()
+        self.uploaded: List[str] = []
+        self.image_ids: List[str] = []
+        self.rejected: set = set()
+
+
+def form_fields(content_type: str, body: bytes) -> Dict[str, bytes]:
+    message = BytesParser(policy=policy.default).parsebytes(
+        b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+    return {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+            for part in message.iter_parts()}
+
+
+def make_handler(state: StandIn) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+        def reply(self, status: int, body: bytes = b'', headers: Dict[str, str] = {}) -> None:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self) -> None:
+            if self.path == '/comparison':
+                self.reply(200, b'', {'Set-Cookie': 'XSRF-TOKEN=stand-in; Path=/'})
+            else:
+                self.reply(404)
+
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            with state.lock:
+                state.requests[self.path] += 1
+                first = state.requests[self.path] == 1
+
+            if self.path == '/upload/comparison':
+                if first:
+                    return self.reply(503)
+                fields = form_fields(self.headers['Content-Type'], body)
+                images = []
+                x = 0
+                while f'comparisons[{x}].name' in fields:
+                    count = sum(1 for name in fields if name.startswith(f'comparisons[{x}].imageNames['))
+                    images.append([str(uuid.uuid4()) for i in range(count)])
+                    x += 1
+                with state.lock:
+                    state.image_ids = [image_id for section in images for image_id in section]
+                self.reply(200, json.dumps({'key': 'standin', 'collectionUuid': str(uuid.uuid4()),
+                                            'images': images}).encode())
+
+            elif self.path == '/upload/image':
+                image_id = form_fields(self.headers['Content-Type'], body)['imageUuid'].decode()
+                with state.lock:
+                    state.image_tries[image_id] += 1
+                    if image_id in state.rejected:
+                        return self.reply(400)
+                    if state.image_tries[image_id] == 1:
+                        return self.reply(503)
+                    state.uploaded.append(image_id)
+                self.reply(200, b'OK')
+
+            else:
+                self.reply(403)
+
+    return Handler
+
+
+def check(name: str, passed: bool, failures: List[str]) -> None:
+    print(f'{"ok    " if passed else "FAILED"} {name}')
+    if not passed:
+        failures.append(name)
+
+
+def expect_error(func: Callable[[], object]) -> bool:
+    try:
+        func()
+    except RuntimeError:
+        return True
+    return False
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Check the slow.pics upload code of comp.py against a local stand-in server: '
+                    'retries on 5xx, no retries on 4xx, the upload journal and resuming from it.')
+    parser.add_argument('--frames', '-f', dest='frames', type=int, default=3,
+                        help='Number of frames in the comparison')
+    args = parser.parse_args()
+
+    state = StandIn()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    comp.slowpics_address = f'http://127.0.0.1:{server.server_address[1]}'
+
+    failures = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            files = ['[A] episode.mkv', '[B] episode.mkv']
+            for file in files:
+                with open(file, 'wb') as f:
+                    f.write(os.urandom(4096))
+
+            frames = [100 * (i + 1) for i in range(args.frames)]
+            suffixes = ['A', 'B']
+            screen_dir = 'screens'
+            os.mkdir(screen_dir)
+            for frame in frames:
+                for suffix in suffixes:
+                    with open(f'{screen_dir}/{frame} - {suffix}.png', 'wb') as f:
+                        f.write(os.urandom(1024))
+
+            sess = comp.slowpics_session()
+            journal = comp.create_comparison(sess, frames, suffixes, 'stand-in', files)
+            check('comparison is created after a 503', state.requests['/upload/comparison'] == 2, failures)
+            check('journal has an image id for every image',
+                  len(journal['image_ids']) == len(frames) * len(suffixes) == len(state.image_ids), failures)
+
+            # upload half, as if the script was stopped halfway
+            half = journal['image_files'][:len(journal['image_files']) // 2]
+            for image_file in half:
+                comp.upload_image(sess, journal, screen_dir, image_file)
+            sess.close()
+            check('every image is uploaded after a 503', len(state.uploaded) == len(half)
+                  and all(state.image_tries[image_id] == 2 for image_id in state.uploaded), failures)
+
+            journal = comp.read_upload_journal()
+            check('journal lists the uploaded images', journal is not None and journal['done'] == set(state.uploaded),
+                  failures)
+            check('upload of the same files can be resumed', comp.can_resume_upload(journal, screen_dir, files),
+                  failures)
+
+            comp.resume_upload(screen_dir, journal)
+            check('resuming uploads every image exactly once',
+                  sorted(state.uploaded) == sorted(state.image_ids), failures)
+            check('journal is removed once everything is uploaded',
+                  not os.path.exists(comp.upload_journal_filename), failures)
+
+            with comp.slowpics_session() as sess:
+                journal = comp.create_comparison(sess, frames, suffixes, 'stand-in', files)
+            state.rejected = {journal['image_ids'][0]}
+            try:
+                comp.resume_upload(screen_dir, journal)
+                stopped = False
+            except SystemExit:
+                stopped = True
+            check('failed upload stops the script and keeps it in the journal', stopped
+                  and comp.read_upload_journal()['done'] == set(journal['image_ids'][1:]), failures)
+
+            with open(files[0], 'ab') as f:
+                f.write(b'changed')
+            check('upload of changed files is not resumed',
+                  not comp.can_resume_upload(comp.read_upload_journal(), screen_dir, files), failures)
+
+            with comp.slowpics_session() as sess:
+                rejected = expect_error(lambda: comp.slowpics_post(sess, '/upload/rejected', lambda: {'field': 'value'}))
+            check('4xx fails without retrying', rejected and state.requests['/upload/rejected'] == 1, failures)
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+
+    if failures:
+        sys.exit(f'{len(failures)} check(s) failed.')
+    print('All checks passed.')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,7 @@ This script was originally written for VS R53 and Python 3.9. It's been tested o
 
 You'll need:
 - Vapoursynth (https://github.com/vapoursynth/vapoursynth/releases)
-- "pip install pathlib anitopy pyperclip requests requests_toolbelt natsort vstools rich colorama" in terminal (without quotes)
+- "pip install pathlib anitopy pyperclip requests requests_toolbelt natsort vstools rich colorama numpy" in terminal (without quotes)
 - "vsrepo install imwri lsmas sub" in terminal (without quotes) or the following installed to your usual Vapoursynth plugins folder:
     - https://github.com/AkarinVS/L-SMASH-Works/releases/latest
     - https://github.com/vapoursynth/subtext/releases/latest
@@ -32,12 +32,16 @@ user_frames = []
 # Number of frames to choose randomly. Completely separate from frame_count_bright, frame_count_dark, and save_frames. Will change every time you run the script.
 random_frames = 5
 
-# Save the brightness data in a text file so it doesn't have to be reanalysed next time the script is run. Frames will be reanalysed if show/movie name or episode numbers change.
-# Does not save user_frames or random_frames.
+# Save the brightness and motion data of every analyzed video so it doesn't have to be reanalysed next time the script is run.
+# Data is stored per video file, so it is reused across shows, folders, trims and fps changes. Does not save user_frames or random_frames.
 save_frames = True
 
 # Use ffmpeg as the image renderer. (ffmpeg needs to be in path)
 ffmpeg = True
+# Use the built-in PNG encoder as the image renderer, which encodes screenshots on all CPU cores at once. Takes priority over ffmpeg.
+python_png = False
+# Compression level of the built-in PNG encoder, from 0 (fastest, biggest files) to 9 (slowest, smallest files).
+png_compression = 6
 # Print frame info on screenshots.
 frame_info = True
 # Upscale videos to make the clips match the highest found res.
@@ -107,8 +111,8 @@ analyze_clip = ""
 
 # Random seed to use in frame selection algorithm. May change selected frames. Recommended to leave as default
 random_seed = 20202020
-# Filename of the text file in which the brightness data will be stored. Recommended to leave as default.
-frame_filename = "generated.compframes"
+# Directory in which the brightness data and other data shared between runs will be stored. Leave empty to use the default cache directory of your system.
+cache_dirname = ""
 # Directory in which the screenshots will be kept
 screen_dirname = "screens"
 # Minimum time between dark and light frames, in seconds. Motion frames use half this value
@@ -116,27 +120,112 @@ screen_separation = 10
 # Number of frames in each direction over which the motion data will be averaged out. So a radius of 4 would take the average of 9 frames, the frame in the middle, and 4 in each direction.
 # Higher value will make it less likely scene changes get picked up as motion, but may lead to less precise results.
 motion_diff_radius = 4
+# Range of average brightness (0 to 1) in which a frame counts as a dark or a bright frame.
+dark_range = (0.062746, 0.380000)
+bright_range = (0.450000, 0.800000)
+# Number of frames requested ahead of time while analyzing. Set to 0 to fit as many as ram_limit allows, up to twice the number of Vapoursynth threads.
+analysis_prefetch = 0
+# Analyze only the luma of the video, shrunk by this factor in width and height. 4 or 8 makes analyzing 4K videos several times faster. 1 analyzes the full resolution.
+analysis_proxy = 1
+# Also analyze the full resolution when analysis_proxy is used, and print how much the selected frames differ.
+validate_proxy = False
+# Analyze only every this many frames at first, or only the keyframes with "keyframes". Afterwards, every frame around the places with the most motion is analyzed.
+# Dark and light frames are picked from the analyzed frames only. Which frames are analyzed depends on random_seed. 1 analyzes every frame.
+analysis_subsample = 1
+# Number of images uploaded to slow.pics at the same time.
+upload_workers = 4
+# Number of times a failed upload is retried. The wait between tries doubles every time, starting at 1 second.
+upload_retries = 5
+# File in which the upload progress is kept, so an interrupted upload continues where it stopped the next time the script is run.
+upload_journal_filename = "slowpics.journal"
+# Address of slow.pics. Only change this to test uploading against a local server.
+slowpics_address = "https://slow.pics"
+# File to which the time, frames and memory used by every stage are written, as Chrome trace events. Open it in chrome://tracing or ui.perfetto.dev. Leave empty to not record anything.
+trace_file = ""
+# Copy the slow.pics url, open it in the browser and wait a bit before closing. Turned off when running in batch mode.
+interactive = True
 
 ### Not recommended to change stuff below
-import os, sys, time, textwrap, re, uuid, random, pathlib, requests, vstools, webbrowser, colorama, shutil, zipfile, lzma, fractions
+import os, sys, time, textwrap, re, copy, uuid, random, pathlib, requests, vstools, webbrowser, colorama, shutil, zipfile, lzma, fractions, collections, hashlib, json, struct, math, concurrent.futures, subprocess, threading, zlib, multiprocessing, contextlib, traceback
 from rich.progress import Progress, BarColumn, TextColumn, TimeRemainingColumn
 from natsort import os_sorted
 import anitopy as ani
+import numpy as np
 import pyperclip as pc
 import vapoursynth as vs
 from requests import Session
-from functools import partial
+from functools import partial, lru_cache
 from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor
 from typing import Any, Dict, List, Optional, BinaryIO, Union, Callable, TypeVar, Sequence, cast
 RenderCallback = Callable[[int, vs.VideoFrame], None]
 VideoProp = Union[int, Sequence[int],float, Sequence[float],str, Sequence[str],vs.VideoNode, Sequence[vs.VideoNode],vs.VideoFrame, Sequence[vs.VideoFrame],Callable[..., Any], Sequence[Callable[..., Any]]]
 T = TypeVar("T", bound=VideoProp)
 vs.core.max_cache_size = ram_limit
+#number of threads Vapoursynth may use at most, govern_memory lowers the thread count when memory is short
+core_threads = vs.core.num_threads
 colorama.init()
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
+trace_events = []
+trace_lock = threading.Lock()
+trace_start = time.perf_counter()
+
+#memory in use right now: the Vapoursynth frame cache, and the highest memory usage of the process so far where the system reports it
+def memory_usage() -> Dict[str, int]:
+    usage = {}
+
+    try:
+        usage["framebuffer_bytes"] = vs.core.core_info.used_framebuffer_size
+    except AttributeError:
+        usage["framebuffer_bytes"] = vs.core.get_core_info()["used_framebuffer_size"]
+
+    if resource is not None:
+        #linux reports kilobytes, mac bytes
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        usage["peak_rss_bytes"] = peak if sys.platform == "darwin" else peak * 1024
+
+    return usage
+
+#record the time, frames and memory of a stage of the script, if trace_file is set
+#works as a context manager, which gives a dict in which "frames" can be counted up, or as a decorator
+@contextlib.contextmanager
+def trace_stage(name: str, **args):
+    stage = {"frames": 0} | args
+
+    if trace_file == "":
+        yield stage
+        return
+
+    start = time.perf_counter()
+    try:
+        yield stage
+    finally:
+        end = time.perf_counter()
+        memory = memory_usage()
+
+        with trace_lock:
+            trace_events.append({"name": name, "cat": "comp", "ph": "X", "ts": (start - trace_start) * 1e6, "dur": (end - start) * 1e6,
+                                 "pid": os.getpid(), "tid": threading.get_ident(), "args": stage | memory})
+            trace_events.append({"name": "memory", "ph": "C", "ts": (end - trace_start) * 1e6, "pid": os.getpid(), "args": memory})
+
+#write the recorded stages to trace_file
+def write_trace():
+    if trace_file == "" or len(trace_events) == 0:
+        return
+
+    with trace_lock:
+        with open(trace_file, 'w') as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+frame_info_style = "sans-serif,20,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,""0,0,0,0,100,100,0,0,1,2,0,7,10,10,10,1"
+
 def FrameInfo(clip: vs.VideoNode,
               title: str,
-              style: str = "sans-serif,20,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,""0,0,0,0,100,100,0,0,1,2,0,7,10,10,10,1",
+              style: str = frame_info_style,
               newlines: int = 3,
               pad_info: bool = False) -> vs.VideoNode:
     """
@@ -171,25 +260,129 @@ def FrameInfo(clip: vs.VideoNode,
 
     return clip
 
+#render text the way sub.Subtitle would draw it on clip, and crop it to the part that has text
+#returns the RGB24 text, its alpha mask and the position of the top left corner, or None if nothing is drawn
+def text_tiles(clip: vs.VideoNode, texts: List[str], style: str = frame_info_style) -> List[Optional[tuple]]:
+    blank = vs.core.std.BlankClip(clip, format=vs.RGB24, length=1)
+    rendered = [vs.core.sub.Subtitle(blank, text=[text], style=style, blend=False) for text in texts]
+    masks = [text.std.PropToClip(prop="_Alpha") for text in rendered]
+
+    #render every text at the same time
+    futures = [mask.get_frame_async(0) for mask in masks]
+
+    tiles = []
+    for text, mask, future in zip(rendered, masks, futures):
+        alpha = np.asarray(future.result()[0])
+        rows = np.flatnonzero(alpha.any(axis=1))
+        columns = np.flatnonzero(alpha.any(axis=0))
+
+        if rows.size == 0:
+            tiles.append(None)
+            continue
+
+        x, y = int(columns[0]), int(rows[0])
+        width, height = int(columns[-1]) - x + 1, int(rows[-1]) - y + 1
+        tiles.append((text.std.CropAbs(width, height, x, y), mask.std.CropAbs(width, height, x, y), x, y))
+
+    return tiles
+
+#draw a tile from text_tiles on a clip, only the area under the tile is merged
+def paste_tile(clip: vs.VideoNode, tile: tuple) -> vs.VideoNode:
+    text, mask, x, y = tile
+    area = vs.core.std.MaskedMerge(clip.std.CropAbs(text.width, text.height, x, y), text, mask)
+
+    row = [area]
+    if x > 0:
+        row.insert(0, clip.std.CropAbs(x, text.height, 0, y))
+    if x + text.width < clip.width:
+        row.append(clip.std.CropAbs(clip.width - x - text.width, text.height, x + text.width, y))
+
+    rows = [vs.core.std.StackHorizontal(row) if len(row) > 1 else area]
+    if y > 0:
+        rows.insert(0, clip.std.CropAbs(clip.width, y, 0, 0))
+    if y + text.height < clip.height:
+        rows.append(clip.std.CropAbs(clip.width, clip.height - y - text.height, 0, y + text.height))
+
+    return vs.core.std.StackVertical(rows) if len(rows) > 1 else area
+
+#same overlay as FrameInfo on an RGB24 clip, but only on frame_numbers
+#every text is rendered once and only the area with text is merged, without a python function being called for every frame
+#picture_types has the _PictType of every frame in frame_numbers, frames without one show N/A
+def frame_info_overlay(clip: vs.VideoNode, title: str, frame_numbers: List[int], picture_types: Dict[int, Optional[str]], style: str = frame_info_style) -> vs.VideoNode:
+    frame_numbers = sorted(set(frame_numbers))
+    texts = [f"Frame {n} of {clip.num_frames}\nPicture type: {picture_types.get(n) or 'N/A'}" for n in frame_numbers]
+    tiles = text_tiles(clip, texts + [" " + "\n" * 3 + title], style)
+    title_tile = tiles.pop()
+
+    #frames in between are passed through as they are
+    segments = []
+    start = 0
+    for n, tile in zip(frame_numbers, tiles):
+        if n > start:
+            segments.append(clip[start:n])
+
+        frame = clip[n]
+        for overlay in (tile, title_tile):
+            if overlay is not None:
+                frame = paste_tile(frame, overlay)
+        segments.append(frame)
+        start = n + 1
+
+    if start < clip.num_frames:
+        segments.append(clip[start:])
+
+    return vs.core.std.Splice(segments) if len(segments) > 1 else segments[0]
+
+#_PictType of frame_numbers of a clip made by init_clip, taken from the index of its file when possible instead of decoding the frames
+#frame_map is the source frame of every frame of the clip, see source_frame_map. blank frames have no picture type
+def clip_picture_types(file: str, frame_map: np.ndarray, frame_numbers: List[int]) -> Dict[int, Optional[str]]:
+    source = open_source(file)
+    picture_types = read_picture_types(file)
+    source_frames = {n: int(frame_map[n]) if n < len(frame_map) else -1 for n in frame_numbers}
+
+    if picture_types is not None and len(picture_types) == source.num_frames:
+        return {n: str(picture_types[s]) if s >= 0 else None for n, s in source_frames.items()}
+
+    #without an index, read the props of the source frames, a few at a time
+    result = {}
+    pending = collections.deque()
+    for n, s in source_frames.items():
+        if s < 0:
+            result[n] = None
+            continue
+
+        pending.append((n, source.get_frame_async(s)))
+        if len(pending) >= core_threads:
+            n, future = pending.popleft()
+            result[n] = future.result().props.get("_PictType")
+
+    while pending:
+        n, future = pending.popleft()
+        result[n] = future.result().props.get("_PictType")
+
+    return {n: value.decode() if isinstance(value, bytes) else value for n, value in result.items()}
+
 #used in lazylist to select frames
+#keeps every frame that is at least diff_thr seconds after the last kept frame
 def dedupe(clip: vs.VideoNode, framelist: list, framecount: int, diff_thr: int, seed: int = None, motion: bool = False):
-    framelist.sort()
-    
-    framelist_dedupe = [framelist[0]]
+    frames = np.sort(np.asarray(framelist, dtype=np.int64))
 
-    thr = round(clip.fps_num / clip.fps_den * diff_thr)
-    lastval = framelist[0]
+    if frames.size == 0:
+        return []
 
-    for i in range(1, len(framelist)):
-
-        checklist = framelist[0:i]
-        x = framelist[i]
+    thr = round(clip.fps_num / clip.fps_den * diff_thr)
 
-        for y in checklist:
-            if x >= y + thr and x >= lastval + thr:
-                framelist_dedupe.append(x)
-                lastval = x
+    #jump straight to the first frame that is far enough from the last kept frame, instead of checking every frame
+    if thr > 0:
+        keep = [0]
+        while True:
+            next_index = int(np.searchsorted(frames, frames[keep[-1]] + thr, side="left"))
+            if next_index >= frames.size:
                 break
+            keep.append(next_index)
+        frames = frames[keep]
+
+    framelist_dedupe = frames.tolist()
 
     #if motion, dont select randomly. give ordered list
     if motion:
@@ -201,8 +394,197 @@ def dedupe(clip: vs.VideoNode, framelist: list, framecount: int, diff_thr: int,
     
     return framelist_dedupe
 
+#get frames sorted by their average difference over diff_radius frames in each direction, highest first
+#frames closer than diff_radius to either end of the clip are left out
+#frames that weren't analyzed (NaN) are left out of the average, and frames without any analyzed frame in their window are left out of the ranking
+#with complete, only frames whose whole window was analyzed are ranked, so a single coarse sample can't outrank refined frames
+def rank_motion(diff: list, num_frames: int, diff_radius: int, complete: bool = False) -> np.ndarray:
+    diff = np.asarray(diff, dtype=np.float64)[:num_frames]
+    window = diff_radius * 2 + 1
+
+    if diff.size < window:
+        return np.zeros(0, dtype=np.int64)
+
+    measured = ~np.isnan(diff)
+
+    #sliding window sum from the cumulative sum, so every frame costs the same regardless of radius
+    cumsum = np.concatenate(([0.0], np.cumsum(np.where(measured, diff, 0.0))))
+
+    if measured.all():
+        avg_diff = (cumsum[window:] - cumsum[:-window]) / window
+        #stable sort keeps frames with equal values in frame order
+        order = np.argsort(-avg_diff, kind="stable")
+    else:
+        counts = np.concatenate(([0], np.cumsum(measured)))
+        counts = counts[window:] - counts[:-window]
+        avg_diff = (cumsum[window:] - cumsum[:-window]) / np.maximum(counts, 1)
+        order = np.argsort(-avg_diff, kind="stable")
+        order = order[counts[order] >= (window if complete else 1)]
+
+    return order + diff_radius
+
+#remove frames marked in the `selected` bitmap from a list of frames
+#frames used to be removed with list.remove() while iterating over the same list, which skipped the frame after every removal.
+#to keep the same frames being picked, only every other frame of a run of selected frames is removed
+def remove_selected(frames: np.ndarray, selected: np.ndarray) -> np.ndarray:
+    hit = selected[frames]
+    index = np.arange(frames.size)
+    run_start = np.maximum.accumulate(np.where(hit, 0, index + 1))
+    return frames[~(hit & ((index - run_start) % 2 == 0))]
+
+#build the brightness and motion graph once and yield (n, avg, motion, scenechange) for every frame of the clip, or only for frame_numbers if given
+#frames are requested asynchronously, with at most `prefetch` requests in flight at once
+#source is the clip that clip was made from, e.g. before proxy_clip. every request decodes a frame of it, so the memory budget is based on its size
+def analysis_stream(clip: vs.VideoNode, motion: bool = True, scenechange: bool = False, prefetch: int = analysis_prefetch, frame_numbers: Sequence[int] = None,
+                    source: vs.VideoNode = None):
+    stats_clip = clip.std.PlaneStats()
+
+    if scenechange:
+        stats_clip = vs.core.misc.SCDetect(stats_clip)
+
+    if motion:
+        gray = vstools.get_y(clip)
+
+        #shift the clip by one frame so that every frame is compared to the one before it (frame 0 is compared to a blank frame)
+        gray_last = (vs.core.std.BlankClip(gray, length=1) + gray)[:gray.num_frames]
+
+        #make diff between frame and last frame, with prewitt (difference is white on black background)
+        diff_clip = vs.core.std.MakeDiff(gray_last, gray)
+        diff_clip = vs.core.std.Prewitt(diff_clip)
+        diff_clip = diff_clip.std.PlaneStats()
+
+    pending = collections.deque()
+
+    def request(n: int):
+        pending.append((n, stats_clip.get_frame_async(n), diff_clip.get_frame_async(n) if motion else None))
+
+    def collect():
+        n, stats_future, diff_future = pending.popleft()
+        props = stats_future.result().props
+        motion_value = diff_future.result().props["PlaneStatsAverage"] if diff_future is not None else None
+        scenechange_value = props["_SceneChangePrev"] if scenechange else None
+        return n, props["PlaneStatsAverage"], motion_value, scenechange_value
+
+    if frame_numbers is None:
+        frame_numbers = range(clip.num_frames)
+
+    with contextlib.ExitStack() as stack:
+        #every frame is requested from the motion node as well, so each step of prefetch is two requests
+        if prefetch <= 0:
+            nodes = [stats_clip, diff_clip] if motion else [stats_clip]
+            prefetch = max(1, stack.enter_context(govern_memory(nodes, [source if source is not None else clip] * len(nodes))) // len(nodes))
+
+        for n in frame_numbers:
+            request(int(n))
+            if len(pending) >= prefetch:
+                yield collect()
+
+        while pending:
+            yield collect()
+
+#luma of a clip, point resized to 1/divisor of its width and height
+#brightness and motion only need a rough picture, and a small clip is much faster to measure
+def proxy_clip(clip: vs.VideoNode, divisor: int = analysis_proxy) -> vs.VideoNode:
+    if divisor <= 1:
+        return clip
+
+    return vstools.get_y(clip).resize.Point(max(1, clip.width // divisor), max(1, clip.height // divisor))
+
+#frames to analyze first, see analysis_subsample
+#every subsample-th frame starting at a random offset, or the keyframes. when keyframes aren't known, about one frame per second is used
+def analysis_samples(clip: vs.VideoNode, subsample: Union[int, str] = analysis_subsample, keyframes: np.ndarray = None, seed: int = random_seed) -> np.ndarray:
+    if subsample == "keyframes":
+        if keyframes is not None and np.count_nonzero(keyframes < clip.num_frames) > 1:
+            return keyframes[keyframes < clip.num_frames]
+
+        step = max(1, round(clip.fps_num / max(1, clip.fps_den)))
+    else:
+        step = max(1, int(subsample))
+
+    if step == 1:
+        return np.arange(clip.num_frames)
+
+    offset = random.Random(seed).randrange(step)
+    return np.arange(offset, clip.num_frames, step)
+
+#frames that haven't been analyzed yet around the places with the most motion in the analyzed frames
+#the best places are spread at least `spacing` frames apart, and the frames within spacing + diff_radius of them are returned
+def motion_refinement(diff: np.ndarray, motion_frames: int, diff_radius: int, spacing: int) -> np.ndarray:
+    #more places than motion frames, because some of them will turn out to have less motion or to be dark or light frames
+    centers = []
+    for center in rank_motion(diff, len(diff), diff_radius):
+        if all(abs(center - other) > spacing for other in centers):
+            centers.append(center)
+            if len(centers) >= motion_frames * 4:
+                break
+
+    refine = np.zeros(len(diff), dtype=bool)
+    for center in centers:
+        refine[max(0, center - spacing - diff_radius):center + spacing + diff_radius + 1] = True
+
+    return np.flatnonzero(refine & np.isnan(diff))
+
+#analyze a clip with a progress bar
+#returns arrays of average brightness, motion (empty if not analyzed) and scene changes (empty if not analyzed)
+#the clip is analyzed at 1/proxy of its resolution, see proxy_clip
+#with subsample, only some frames are analyzed first and the rest of the arrays is NaN. frames around the best motion_frames places are analyzed afterwards
+def measure_clip(clip: vs.VideoNode, motion: bool = True, scenechange: bool = False, message: str = "Analyzing video", proxy: int = analysis_proxy,
+                 subsample: Union[int, str] = analysis_subsample, keyframes: np.ndarray = None, motion_frames: int = 0, diff_radius: int = motion_diff_radius, seed: int = random_seed):
+    source, clip = clip, proxy_clip(clip, proxy)
+    avg = np.full(clip.num_frames, np.nan, dtype=np.float64)
+    diff = np.full(clip.num_frames if motion else 0, np.nan, dtype=np.float64)
+    scenechanges = np.full(clip.num_frames if scenechange else 0, np.nan, dtype=np.float64)
+
+    samples = analysis_samples(clip, subsample, keyframes, seed)
+
+    with trace_stage("analysis", width=clip.width, height=clip.height, subsample=str(subsample)) as stage, \
+         Progress(TextColumn("{task.description}"), BarColumn(), TextColumn("{task.completed}/{task.total}"), TextColumn("{task.percentage:>3.02f}%"), TimeRemainingColumn()) as progress:
+        analysis_progress = progress.add_task(message, total=len(samples))
+
+        def measure(frame_numbers: Sequence[int]):
+            for n, avg_value, motion_value, scenechange_value in analysis_stream(clip, motion=motion, scenechange=scenechange, frame_numbers=frame_numbers, source=source):
+                avg[n] = avg_value
+
+                if motion_value is not None:
+                    diff[n] = motion_value
+
+                if scenechange_value is not None:
+                    scenechanges[n] = scenechange_value
+
+                progress.update(analysis_progress, advance=1)
+
+            stage["frames"] += len(frame_numbers)
+
+        measure(samples)
+
+        if len(samples) < clip.num_frames and motion and motion_frames > 0:
+            refine = motion_refinement(diff, motion_frames, diff_radius, int(np.diff(samples).max()) if len(samples) > 1 else clip.num_frames)
+            progress.update(analysis_progress, total=len(samples) + len(refine))
+            measure(refine)
+
+    return avg, diff, scenechanges
+
+#progress bar message for analyzing a file
+#if group name is present, display only it and color it cyan. if group name isnt present, display file name and color it yellow.
+def analysis_message(file: str = None, files: list = None, files_info: list = None) -> str:
+    if file is None or files is None or files_info is None:
+        return "Analyzing video"
+
+    suffix = get_suffix(file, files, files_info)
+    if suffix == files_info[files.index(file)].get("file_name"):
+        return f'Analyzing video: [yellow]{suffix.strip()}'
+    else:
+        return f"Analyzing video: [cyan]{suffix.strip()}"
+
+#masks of the dark and light frames. frames that are in both ranges are dark
+def brightness_classes(avg: np.ndarray):
+    dark = (avg >= dark_range[0]) & (avg <= dark_range[1])
+    light = (avg >= bright_range[0]) & (avg <= bright_range[1]) & ~dark
+    return dark, light
+
 def lazylist(clip: vs.VideoNode, dark_frames: int = 25, light_frames: int = 15, motion_frames: int = 0, seed: int = random_seed, diff_thr: int = screen_separation, diff_radius: int = motion_diff_radius,
-             dark_list: list = None, light_list: list = None, motion_list: list = None, save_frames: bool = False, file: str = None, files: list = None, files_info: list = None):
+             stats: tuple = None, save_frames: bool = False, file: str = None, files: list = None, files_info: list = None, proxy: int = analysis_proxy,
+             keyframes: np.ndarray = None):
     """
     Blame Sea for what this shits out.
     A function for generating a list of frames for comparison purposes.
@@ -216,128 +598,90 @@ def lazylist(clip: vs.VideoNode, dark_frames: int = 25, light_frames: int = 15,
     :param light_frame:   Number of light frames
     :param seed:          seed for `random.sample()`
     :param diff_thr:      Minimum distance between each frames (In seconds)
-    :return:              List of dark and light frames
+    :param stats:         Previously analyzed (average, motion) arrays. Clip is analyzed if not given
+    :param proxy:         Factor the clip is shrunk by before analyzing it
+    :param keyframes:     Keyframes of the clip, used when `analysis_subsample` is "keyframes"
+    :return:              List of dark and light frames, and the (average, motion) arrays if `save_frames` is set
     """
 
     all_dedupe = []
 
     #if no frames were requested, return empty list before running algorithm
     if dark_frames + light_frames + motion_frames == 0:
-        return [], dark_list, light_list, motion_list
+        return [], stats
 
-    dark = []
-    light = []
-    diff = []
     motion = []
 
-    if dark_list is None or light_list is None or motion_list is None:
-
-        def checkclip(n, f, clip):
-            avg = f.props["PlaneStatsAverage"]
-
-            if 0.062746 <= avg <= 0.380000:
-                dark.append(n)
-
-            elif 0.450000 <= avg <= 0.800000:
-                light.append(n)
-
-            if motion_list is None and motion_frames > 0:
-
-                #src = mvf.Depth(clip, 5)
-                gray = vstools.get_y(clip)
-
-                gray_last = vs.core.std.BlankClip(gray)[0] + gray
-
-                #make diff between frame and last frame, with prewitt (difference is white on black background)
-                diff_clip = vs.core.std.MakeDiff(gray_last, gray)
-                diff_clip = vs.core.std.Prewitt(diff_clip)
-
-                diff_clip = diff_clip.std.PlaneStats()
-
-                #print(n, f, diff.get_frame(n))
-
-                diff.append(diff_clip.get_frame(n).props["PlaneStatsAverage"])
-
-            return clip
-
-        s_clip = clip.std.PlaneStats()
-
-        eval_frames = vs.core.std.FrameEval(clip, partial(checkclip, clip=s_clip), prop_src=s_clip)
-
-        #if group name is present, display only it and color it cyan. if group name isnt present, display file name and color it yellow.
-        if file is not None and files is not None and files_info is not None:
-            suffix = get_suffix(file, files, files_info)
-            if suffix == files_info[files.index(file)].get("file_name"):
-                message = f'Analyzing video: [yellow]{suffix.strip()}'
-            else:
-                message = f"Analyzing video: [cyan]{suffix.strip()}"
-        else:
-            message = "Analyzing video"
-
-        vstools.clip_async_render(eval_frames, progress=message)     
+    if stats is None:
+        avg, diff, _ = measure_clip(clip, motion_frames > 0, message=analysis_message(file, files, files_info), proxy=proxy, keyframes=keyframes, motion_frames=motion_frames, diff_radius=diff_radius, seed=seed)
+        stats = (avg, diff)
 
     else:
-        dark = dark_list
-        light = light_list
-        diff = motion_list 
-
-    #remove frames that are within diff_thr seconds of other frames. for dark and light, select random frames as well
-    dark_dedupe = dedupe(clip, dark, dark_frames, diff_thr, seed)
-    light_dedupe = dedupe(clip, light, light_frames, diff_thr, seed)
-    all_dedupe += (dark_dedupe + light_dedupe)   
+        avg, diff = stats
 
-    #find frames with most motion
-    if motion_frames > 0:
+    #the analysis above is its own stage, so this one only times the selection itself
+    with trace_stage("selection"):
+        #sort frames into dark and light frames based on their average brightness
+        dark, light = brightness_classes(avg)
+        dark = np.flatnonzero(dark).tolist()
+        light = np.flatnonzero(light).tolist()
 
-        avg_diff = []
+        #remove frames that are within diff_thr seconds of other frames. for dark and light, select random frames as well
+        dark_dedupe = dedupe(clip, dark, dark_frames, diff_thr, seed)
+        light_dedupe = dedupe(clip, light, light_frames, diff_thr, seed)
+        all_dedupe += (dark_dedupe + light_dedupe)   
 
-        #get average difference over diff_radius frames in each direction
-        #store frame number in avg_diff as well in the form [frame, avg_diff]
-        for i, d in enumerate(diff):
+        #find frames with most motion
+        if motion_frames > 0:
 
-            if i >= (diff_radius) and i < (clip.num_frames - diff_radius):
-                if isinstance(d, float):
-                    surr_frames = diff[i-diff_radius:i+diff_radius+1]
-                    mean = sum(surr_frames) / len(surr_frames)
-                    avg_diff.append([i, mean])
+            #frames that were already selected as dark or light frames
+            selected = np.zeros(max(clip.num_frames, len(diff)) + 1, dtype=bool)
+            selected[dark_dedupe + light_dedupe] = True
 
-        #sort avg_diff list based on the diff values, not the frame numbers
-        sorted_avg_diff = sorted(avg_diff, key=lambda x: x[1], reverse=True)
+            #frames sorted by their average difference over diff_radius frames in each direction, with dark and light frames removed
+            ranked = remove_selected(rank_motion(diff, clip.num_frames, diff_radius, complete=True), selected)
 
-        #remove frames that are in light or dark list from motion list
-        for i in sorted_avg_diff:
-            if i[0] in dark_dedupe or i[0] in light_dedupe:
-                sorted_avg_diff.remove(i)
+            #get first motion_frames frames from the ranked frames and dedupe them
+            #if less than motion_frames left, repeat
+            #frames are taken from every other position at the top of the list, the ones in between stay at the top for the next round
+            leftover = []
+            pos = 0
+            while len(motion) < motion_frames and (len(leftover) > 0 or pos < ranked.size):
 
-        #get first motion_frames frames from sorted_avg_diff and dedupe them
-        #if less than motion_frames left, repeat
-        while len(motion) < motion_frames and len(sorted_avg_diff) > 0:
+                top = leftover + ranked[pos:pos + 2 * motion_frames - 1 - len(leftover)].tolist()
+                pos += len(top) - len(leftover)
+                leftover = top[1::2]
 
-            for i in range(0, motion_frames):
-                if len(sorted_avg_diff) > 0:
-                    motion.append(sorted_avg_diff.pop(i)[0])
+                #remove frames that are too close to other frames. uses lower diff_thr because high motion frames will be different from one another
+                motion = dedupe(clip, motion + top[0::2], motion_frames, round(diff_thr/2), seed, motion=True)
 
-            #remove frames that are too close to other frames. uses lower diff_thr because high motion frames will be different from one another
-            motion = dedupe(clip, motion, motion_frames, round(diff_thr/2), seed, motion=True)
+            #remove dark and light frames from motion_dedupe
+            motion = remove_selected(np.asarray(motion, dtype=np.int64), selected).tolist()
 
-        #remove dark and light frames from motion_dedupe
-        for frame in motion:
-            if frame in dark_dedupe or frame in light_dedupe:
-                motion.remove(frame)
-
-        all_dedupe += motion
+            all_dedupe += motion
 
     print()
 
     if save_frames:
-        dark_list = dark
-        light_list = light
-        motion_list = diff
-
-        return all_dedupe, dark_list, light_list, motion_list
+        return all_dedupe, stats
     else:
         return all_dedupe
 
+#select frames from the full resolution analysis of a clip and print how much proxy analysis differs from it
+#full_stats are the (average, motion) arrays of the full resolution, the clip is analyzed if they aren't given
+def validate_proxy_selection(clip: vs.VideoNode, selected: List[int], proxy_stats: tuple, full_stats: tuple = None, file: str = None, files: list = None, files_info: list = None,
+                             keyframes: np.ndarray = None):
+    print("Validating proxy analysis against full resolution...\n")
+    full_selected, full_stats = lazylist(clip, frame_count_dark, frame_count_bright, frame_count_motion, stats=full_stats, save_frames=True, file=file, files=files, files_info=files_info, proxy=1, keyframes=keyframes)
+
+    proxy_dark, proxy_light = brightness_classes(proxy_stats[0])
+    full_dark, full_light = brightness_classes(full_stats[0])
+    misclassified = np.count_nonzero((proxy_dark != full_dark) | (proxy_light != full_light))
+    matching = len(set(selected) & set(full_selected))
+
+    print(f"Proxy analysis selected {matching} of the {len(full_selected)} frames selected at full resolution ({100 * matching / max(1, len(full_selected)):.1f}%).")
+    print(f"{misclassified} of {len(proxy_stats[0])} frames were sorted into dark and light differently ({100 * misclassified / max(1, len(proxy_stats[0])):.2f}%).\n")
+
 def _get_slowpics_header(content_length: str, content_type: str, sess: Session) -> Dict[str, str]:
     """
     Stolen from vardefunc, fixed by Jimbo
@@ -355,7 +699,196 @@ def _get_slowpics_header(content_length: str, content_type: str, sess: Session)
         "X-XSRF-TOKEN": sess.cookies.get_dict()["XSRF-TOKEN"]
     }
 
-def screengen(progress, task1, task2, clip: vs.VideoNode, folder: str, suffix: str, frame_numbers: List = None, extended: int = 0, start: int = 1):
+#session for slow.pics, with a connection pool big enough for every upload worker
+def slowpics_session(workers: int = upload_workers) -> Session:
+    sess = Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    sess.mount("http://", adapter)
+    sess.mount("https://", adapter)
+    sess.get(f"{slowpics_address}/comparison")
+    return sess
+
+#post a multipart form to slow.pics, retrying with exponential backoff on connection errors, server errors and rate limits
+#make_fields is called again for every try, because files are streamed from disk instead of read into memory first
+def slowpics_post(sess: Session, path: str, make_fields: Callable[[], Dict[str, Any]], retries: int = upload_retries) -> requests.Response:
+    for attempt in range(retries + 1):
+        fields = make_fields()
+        try:
+            body = MultipartEncoder(fields, str(uuid.uuid4()))
+            response = sess.post(f"{slowpics_address}{path}", data=body, headers=_get_slowpics_header(str(body.len), body.content_type, sess))
+            if response.status_code == 200:
+                return response
+            if response.status_code != 429 and response.status_code < 500:
+                raise RuntimeError(f"Upload to {path} failed with status code {response.status_code}.")
+            error = f"status code {response.status_code}"
+        except requests.RequestException as e:
+            error = str(e)
+        finally:
+            for value in fields.values():
+                if isinstance(value, tuple):
+                    value[1].close()
+
+        if attempt < retries:
+            time.sleep(2 ** attempt)
+
+    raise RuntimeError(f"Upload to {path} failed after {retries + 1} tries: {error}")
+
+#read the upload journal. first line is the comparison, every following line is the uuid of an uploaded image
+def read_upload_journal(filename: str = upload_journal_filename):
+    if not os.path.exists(filename):
+        return None
+
+    try:
+        with open(filename) as journal_file:
+            journal = json.loads(journal_file.readline())
+            journal["done"] = set(line.strip() for line in journal_file if line.strip() != "")
+        return journal
+    except (ValueError, KeyError):
+        return None
+
+journal_lock = threading.Lock()
+
+#names and fingerprints of the compared files, kept in the upload journal
+def source_fingerprints(files: List[str]) -> List[list]:
+    return [[os.path.basename(file), file_fingerprint(file)] for file in files]
+
+#check if an interrupted upload can be continued: it has to be of the same files, and all of its screenshots have to still be there
+def can_resume_upload(journal: Optional[dict], screen_dir, files: List[str]) -> bool:
+    if journal is None or not os.path.isdir(screen_dir):
+        return False
+
+    if journal.get("sources") != source_fingerprints(files):
+        return False
+
+    return all(os.path.exists(f"{screen_dir}/{image_file}") for image_file in journal["image_files"])
+
+#create a slow.pics comparison for screenshots that haven't been made yet, and start a new upload journal for it
+#image files are named "{frame} - {suffix}.png", with one image per suffix for every frame
+@trace_stage("create comparison")
+def create_comparison(sess: Session, frames: List[int], suffixes: List[str], collection_name: str, files: List[str] = None) -> dict:
+    browserId = str(uuid.uuid4())
+    fields: Dict[str, Any] = {
+        'collectionName': collection_name,
+        'hentai': str(hentai_flag).lower(),
+        'optimize-images': 'true',
+        'browserId': browserId,
+        'public': str(public_flag).lower()
+    }
+
+    if tmdbID != "":
+        fields |= {'tmdbId': str(tmdbID)}
+    if remove_after != "" and remove_after != 0:
+        fields |= {'removeAfter': str(remove_after)}
+
+    image_files = []
+    for x in range(0, len(frames)):
+        #current_comp is list of image files for this frame
+        current_comp = os_sorted([f"{frames[x]} - {suffix}.png" for suffix in suffixes])
+        #add field for comparison name. after every comparison name there needs to be as many image names as there are comped video files
+        fields[f'comparisons[{x}].name'] = str(frames[x])
+        #iterate over the image files for this frame
+        for i, imageName in enumerate(current_comp):
+            fields[f'comparisons[{x}].imageNames[{i}]'] = imageName.split(' - ', 1)[1].replace(".png", "")
+        image_files += current_comp
+
+    comp_response = slowpics_post(sess, "/upload/comparison", lambda: fields).json()
+
+    #image uuids come back in the same order as the image names were sent
+    journal = {
+        "key": comp_response["key"],
+        "collectionUuid": comp_response["collectionUuid"],
+        "browserId": browserId,
+        "frames": frames,
+        "image_files": image_files,
+        "image_ids": [image_id for image_section in comp_response["images"] for image_id in image_section],
+        "sources": source_fingerprints(files) if files is not None else None,
+    }
+
+    with open(upload_journal_filename, 'w') as journal_file:
+        journal_file.write(json.dumps(journal) + "\n")
+    journal["done"] = set()
+
+    return journal
+
+#upload one screenshot of a comparison and write it to the journal once it's done
+@trace_stage("upload")
+def upload_image(sess: Session, journal: dict, screen_dir, image_file: str):
+    image_id = journal["image_ids"][journal["image_files"].index(image_file)]
+
+    upload_response = slowpics_post(sess, "/upload/image", lambda: {
+        "collectionUuid": journal["collectionUuid"],
+        "imageUuid": image_id,
+        "file": (image_file, open(f"{screen_dir}/{image_file}", 'rb'), 'image/png'),
+        'browserId': journal["browserId"],
+    })
+
+    if upload_response.content.decode() != "OK":
+        raise RuntimeError(f'Upload of "{image_file}" failed: {upload_response.content.decode()}')
+
+    with journal_lock:
+        with open(upload_journal_filename, 'a') as journal_file:
+            journal_file.write(image_id + "\n")
+        journal["done"].add(image_id)
+
+#upload the screenshots of a journal that haven't been uploaded yet
+@trace_stage("resume upload")
+def resume_upload(screen_dir, journal: dict):
+    print("Resuming interrupted upload...")
+
+    failed = []
+    with slowpics_session() as sess:
+        with Progress(TextColumn("{task.description}"), BarColumn(), TextColumn("{task.completed}/{task.total}"), TextColumn("{task.percentage:>3.02f}%"), TimeRemainingColumn()) as progress:
+            upload_progress = progress.add_task("[bright_magenta]Uploading to Slowpoke Pics", total=len(journal["image_files"]), completed=len(journal["done"]))
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=upload_workers) as executor:
+                futures = {executor.submit(upload_image, sess, journal, screen_dir, image_file): image_file for image_id, image_file in zip(journal["image_ids"], journal["image_files"]) if image_id not in journal["done"]}
+
+                for future in concurrent.futures.as_completed(futures):
+                    if future.exception() is None:
+                        progress.update(upload_progress, advance=1)
+                    else:
+                        failed.append((futures[future], future.exception()))
+
+    report_failed_uploads(failed)
+    os.remove(upload_journal_filename)
+
+#print the screenshots that couldn't be uploaded and stop. the journal is kept, so the next run uploads only those
+def report_failed_uploads(failed: List[tuple]):
+    if len(failed) == 0:
+        return
+
+    print()
+    for image_file, error in failed:
+        print(f'Failed to upload "{image_file}": {error}')
+    sys.exit(f"{len(failed)} screenshot(s) could not be uploaded. Run the script again to retry them.")
+
+#share the url of a finished comparison and return it
+def share_comparison(screen_dir, key: str) -> str:
+    slowpics_url = f'{slowpics_address}/c/{key}'
+    print(f'\nSlowpoke Pics url: {slowpics_url}', end='')
+
+    if interactive:
+        pc.copy(slowpics_url)
+
+    if browser_open and interactive:
+        webbrowser.open(slowpics_url)
+
+    if webhook_url:
+        data = {"content": slowpics_url}
+        if requests.post(webhook_url, data).status_code < 300:
+            print('Posted to webhook.')
+        else:
+            print('Failed to post on webhook!')
+
+    if delete_screen_dir and os.path.isdir(screen_dir):
+        shutil.rmtree(screen_dir)
+
+    if interactive:
+        time.sleep(3)
+
+    return slowpics_url
+
+def screengen(progress, task1, task2, clip: vs.VideoNode, folder: str, suffix: str, frame_numbers: List = None, extended: int = 0):
     """
     Stolen from Sea
     Mod of Narkyy's screenshot generator, stolen from awsmfunc.
@@ -363,10 +896,9 @@ def screengen(progress, task1, task2, clip: vs.VideoNode, folder: str, suffix: s
     Not specifying `frame_numbers` will use `ssfunc.util.lazylist()` to generate a list of frames.
     progress, task1, and task2 were added by mcbaws to update the rich progress bar
     :param folder:            Name of folder where screenshots are saved.
-    :param suffix:            Name prepended to screenshots (usually group name).
+    :param suffix:            Name appended to screenshots (usually group name).
     :param frame_numbers:     List of frames to generate screenshots of.
-    :param start:             Frame to start from.
-    :param delim:             Delimiter for the external file.
+    :param extended:          Number of blank frames appended to the start of the clip.
     """
 
     folder_path = f"./{folder}"
@@ -375,29 +907,377 @@ def screengen(progress, task1, task2, clip: vs.VideoNode, folder: str, suffix: s
     if not os.path.isdir(folder_path):
         os.mkdir(folder_path)
 
-    for i, num in enumerate(frame_numbers, start=start):
-        filename = "{path}/{:03d} - {suffix}.png".format(
-            i, path=folder_path, suffix=suffix
-        )
+    render_screens([screen_writer(clip, folder_path, suffix, extended)], frame_numbers, progress, task1, [task2])
 
-        #use of extended variable is to make sure we dont take the props of blank appended clip
+#get a node that saves "{frame} - {suffix}.png" in folder when one of its frames is requested
+#matrix is read from the clip if it isn't given. overlay is applied to the clip after it's converted to RGB
+def screen_writer(clip: vs.VideoNode, folder: str, suffix: str, extended: int = 0, matrix: int = None, overlay: Callable[[vs.VideoNode], vs.VideoNode] = None) -> vs.VideoNode:
+    #use of extended variable is to make sure we dont take the props of blank appended clip
+    if matrix is None:
         matrix = clip.get_frame(extended).props._Matrix
 
-        if matrix == 2:
-            matrix = 1
+    if matrix == 2:
+        matrix = 1
+
+    clip = clip.resize.Spline36(format=vs.RGB24, matrix_in=matrix, dither_type="error_diffusion")
+
+    if overlay is not None:
+        clip = overlay(clip)
+
+    #imwri replaces %d with the frame number, so any % in the suffix has to be escaped
+    return vs.core.imwri.Write(
+        clip,
+        "PNG",
+        f"{folder}/%d - {suffix.replace('%', '%%')}.png",
+        overwrite=True,
+    )
+
+#size of one frame of a clip in bytes
+def frame_size(clip: vs.VideoNode) -> int:
+    if clip.format is None or clip.width == 0:
+        return 3840 * 2160 * 4
+
+    chroma = (clip.width >> clip.format.subsampling_w) * (clip.height >> clip.format.subsampling_h)
+    return (clip.width * clip.height + chroma * (clip.format.num_planes - 1)) * clip.format.bytes_per_sample
+
+#memory needed for one frame request of a node: the output frame, the source frame it's made from and one frame for the filters in between
+def request_footprint(node: vs.VideoNode, source: vs.VideoNode = None) -> int:
+    source_size = frame_size(source) if source is not None else frame_size(node)
+    return frame_size(node) + source_size + max(frame_size(node), source_size)
+
+#split ram_limit between the Vapoursynth cache and the frames requested at once from nodes, and yield how many frames can be requested at once
+#sources are the source clips the nodes are made from, if known. the cache gets room for a few frames of every source, the rest goes to requests
+#the thread count is lowered to the number of requests, threads without a request would only hold more frames
+#the cache size and thread count are set back when the with block ends, so they don't carry over to the next stage
+@contextlib.contextmanager
+def govern_memory(nodes: List[vs.VideoNode], sources: List[vs.VideoNode] = None):
+    if sources is None:
+        sources = [None] * len(nodes)
+
+    budget = ram_limit * 1024 * 1024
+    per_request = max(request_footprint(node, source) for node, source in zip(nodes, sources))
+    min_cache = sum(frame_size(source if source is not None else node) * 4 for node, source in zip(nodes, sources))
+
+    requests = max(1, min(core_threads * 2, (budget - min_cache) // per_request))
+    cache = max(min_cache, budget - requests * per_request)
+
+    previous_cache, previous_threads = vs.core.max_cache_size, vs.core.num_threads
+    vs.core.max_cache_size = max(1, cache // (1024 * 1024))
+    vs.core.num_threads = max(1, min(core_threads, requests))
+    try:
+        yield requests
+    finally:
+        vs.core.max_cache_size = previous_cache
+        vs.core.num_threads = previous_threads
+
+#request frames from several output nodes at once, so every file and frame is rendered in parallel instead of one after another
+#requests are interleaved between nodes, and at most max_requests are in flight at the same time
+#if on_frame is given, it is called with the node index, frame number and frame instead of updating the progress bars
+#orders can give every node its own order of frame_numbers, see decode_order
+def render_screens(nodes: List[vs.VideoNode], frame_numbers: List[int], progress, total_task, node_tasks: list, max_requests: int = None, on_frame: Callable[[int, int, vs.VideoFrame], None] = None,
+                   orders: List[List[int]] = None):
+    if max_requests is None:
+        with govern_memory(nodes) as max_requests:
+            return render_screens(nodes, frame_numbers, progress, total_task, node_tasks, max_requests, on_frame, orders)
+
+    if orders is None:
+        orders = [frame_numbers] * len(nodes)
+
+    pending = {}
+
+    def finish(done):
+        for future in done:
+            i, num = pending.pop(future)
+            frame = future.result()
+
+            if on_frame is not None:
+                on_frame(i, num, frame)
+            else:
+                progress.update(total_task, advance=1)
+                progress.update(node_tasks[i], advance=1)
+
+    for k in range(len(frame_numbers)):
+        for i, node in enumerate(nodes):
+            if len(pending) >= max_requests:
+                finish(concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED).done)
+
+            num = orders[i][k]
+            pending[node.get_frame_async(num)] = (i, num)
+
+    while pending:
+        finish(concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED).done)
+
+#write an RGB image with shape (height, width, 3) as a PNG file
+#every row uses the paeth filter, which is computed for the whole image at once
+def write_png(path: str, rgb: np.ndarray, compression: int = 6):
+    height, width, _ = rgb.shape
+    x = rgb.reshape(height, width * 3).astype(np.int16)
+
+    #left, up and up-left neighbours of every byte, zero outside the image
+    a = np.zeros_like(x)
+    a[:, 3:] = x[:, :-3]
+    b = np.zeros_like(x)
+    b[1:] = x[:-1]
+    c = np.zeros_like(x)
+    c[1:, 3:] = x[:-1, :-3]
+
+    p = a + b - c
+    pa = np.abs(p - a)
+    pb = np.abs(p - b)
+    pc = np.abs(p - c)
+    predictor = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+
+    filtered = np.empty((height, width * 3 + 1), dtype=np.uint8)
+    filtered[:, 0] = 4
+    filtered[:, 1:] = (x - predictor).astype(np.uint8)
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    with open(path, 'wb') as png_file:
+        png_file.write(b"\x89PNG\r\n\x1a\n")
+        png_file.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        png_file.write(chunk(b"IDAT", zlib.compress(filtered, compression)))
+        png_file.write(chunk(b"IEND", b""))
+
+#save screenshots of RGB24 clips with the built-in PNG encoder
+#frames are read straight from the plane buffers and encoded in a thread pool, since numpy and zlib release the GIL while working
+#on_saved is called with the name of every image once it's written
+def png_screens(nodes: List[vs.VideoNode], suffixes: List[str], frame_numbers: List[int], folder: str, progress, total_task, node_tasks: list, on_saved: Callable[[str], None] = None,
+                orders: List[List[int]] = None, max_requests: int = None):
+    if max_requests is None:
+        with govern_memory(nodes) as max_requests:
+            return png_screens(nodes, suffixes, frame_numbers, folder, progress, total_task, node_tasks, on_saved, orders, max_requests)
+
+    #limit the number of frames waiting to be encoded, so rendering can't run ahead of encoding and fill up the ram
+    slots = threading.Semaphore(max_requests)
+    futures = []
+
+    def encode(i: int, num: int, frame: vs.VideoFrame):
+        rgb = np.dstack([np.asarray(frame[plane]) for plane in range(3)])
+        write_png(f"{folder}/{num} - {suffixes[i]}.png", rgb, png_compression)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+
+        def on_frame(i: int, num: int, frame: vs.VideoFrame):
+            slots.acquire()
+            future = executor.submit(encode, i, num, frame)
+
+            def done(future):
+                slots.release()
+                progress.update(total_task, advance=1)
+                progress.update(node_tasks[i], advance=1)
+
+                if on_saved is not None and future.exception() is None:
+                    on_saved(f"{num} - {suffixes[i]}.png")
+
+            future.add_done_callback(done)
+            futures.append(future)
+
+        render_screens(nodes, frame_numbers, progress, total_task, node_tasks, max_requests, on_frame, orders)
+
+    for future in futures:
+        future.result()
+
+#save screenshots of a clip made by get_frames with a single ffmpeg process
+#every frame is piped to ffmpeg once, saved with a numbered name and renamed to "{frame} - {suffix}.png" as soon as ffmpeg is done with it
+#on_saved is called with the name of every image once it's renamed
+def ffmpeg_screens(clip: vs.VideoNode, frame_numbers: List[int], folder: str, suffix: str, progress, task1, task2, prefetch: int = 0, on_saved: Callable[[str], None] = None):
+    clip = clip.std.ShufflePlanes([1, 2, 0], vs.RGB).std.AssumeFPS(fpsnum=1, fpsden=1)
+    numbered = f"{folder}/{uuid.uuid4().hex}_%d.png"
+
+    ffmpeg_line = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-f", "rawvideo", "-video_size", f"{clip.width}x{clip.height}", "-pixel_format", "gbrp", "-framerate", str(clip.fps),
+                   "-i", "pipe:", "-pred", "mixed", "-f", "image2", "-start_number", "0", numbered]
+
+    saved = 0
+
+    def save(i: int):
+        image_file = f"{frame_numbers[i]} - {suffix}.png"
+        os.replace(numbered % i, f"{folder}/{image_file}")
+
+        if on_saved is not None:
+            on_saved(image_file)
+
+    def update(current: int, total: int):
+        nonlocal saved
 
-        #print(f"Saving Frame {i}/{len(frame_numbers)} from {suffix}", end="\r")
-        vs.core.imwri.Write(
-            clip.resize.Spline36(
-                format=vs.RGB24, matrix_in=matrix, dither_type="error_diffusion"
-            ),
-            "PNG",
-            filename,
-            overwrite=True,
-        ).get_frame(num)
+        if current > 0:
+            progress.update(task1, advance=1)
+            progress.update(task2, advance=1)
+
+        #ffmpeg writes the images one after another, so an image is finished once the next one exists
+        while saved + 1 < len(frame_numbers) and os.path.exists(numbered % (saved + 1)):
+            save(saved)
+            saved += 1
+
+    with subprocess.Popen(ffmpeg_line, stdin=subprocess.PIPE) as process:
+        clip.output(cast(BinaryIO, process.stdin), y4m=False, progress_update=update, prefetch=prefetch)
+        process.stdin.close()
+
+    if process.returncode != 0:
+        raise RuntimeError(f'ffmpeg failed to save screenshots of "{suffix}".')
+
+    for i in range(saved, len(frame_numbers)):
+        save(i)
+
+#opened sources and their metadata, so every file is only opened once per run
+sources: Dict[str, vs.VideoNode] = {}
+source_info: Dict[str, dict] = {}
+#metadata of every file seen before, loaded from the cache directory the first time it's needed
+probe_cache: Optional[Dict[str, dict]] = None
+
+#matrix coefficients as named by ffprobe, as Vapoursynth _Matrix values
+probe_matrix = {"gbr": 0, "bt709": 1, "fcc": 4, "bt470bg": 5, "smpte170m": 6, "smpte240m": 7, "ycgco": 8, "bt2020nc": 9, "bt2020c": 10, "smpte2085": 11, "chroma-derived-nc": 12, "chroma-derived-c": 13, "ictcp": 14}
+
+#metadata of a source clip
+def source_metadata(clip: vs.VideoNode) -> dict:
+    return {
+        "width": clip.width,
+        "height": clip.height,
+        "fps_num": clip.fps_num,
+        "fps_den": clip.fps_den,
+        "num_frames": clip.num_frames,
+        "matrix": clip.get_frame(0).props.get("_Matrix", 2),
+    }
+
+#open a file with LWLibavSource, creating its index if it doesn't exist yet, and get its metadata
+#runs in a separate process when files are indexed by index_sources
+def _index_source(file: str) -> dict:
+    return source_metadata(vs.core.lsmas.LWLibavSource(file))
+
+#index all files at the same time, each one in its own process
+#files that already have an index open quickly, so they are left for get_source_info
+#a single new file is indexed in a process as well, so open_source can read its keyframes from the index and open it only once
+#in a batch worker the files were already indexed in the batch pool by run_batch, so whatever is left is indexed in the worker itself instead of starting a pool in every worker
+@trace_stage("indexing")
+def index_sources(files: List[str]):
+    new_files = [file for file in files if file not in source_info and not os.path.exists(f"{file}.lwi")]
+
+    if len(new_files) > 0:
+        print(f"Indexing {len(new_files)} file{'s' if len(new_files) > 1 else ''}...")
+        if batch_worker:
+            infos = map(_index_source, new_files)
+        else:
+            #spawn instead of fork, a forked Vapoursynth core would be left without its threads
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=min(len(new_files), os.cpu_count()), mp_context=multiprocessing.get_context("spawn"))
+            infos = executor.map(_index_source, new_files)
+
+        try:
+            for file, info in zip(new_files, infos):
+                save_source_info(file, info)
+        finally:
+            if not batch_worker:
+                executor.shutdown()
+
+        #the indexes didn't exist when they may have been read before
+        read_index.cache_clear()
+
+    for file in files:
+        get_source_info(file)
 
-        progress.update(task1, advance=1)
-        progress.update(task2, advance=1)
+#read the metadata of the first video stream of a file from its headers with ffprobe, without decoding anything
+#values ffprobe doesn't know are left out, and None is returned if ffprobe isn't installed or can't read the file
+#the fps is r_frame_rate, which doesn't always match what LWLibavSource reports (vfr and field rate streams, mkv timebases), so it's only used for estimates.
+#most mkv files don't store nb_frames, so the probe doesn't save opening those files
+def probe_source(file: str) -> Optional[dict]:
+    if shutil.which("ffprobe") is None:
+        return None
+
+    try:
+        result = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=width,height,r_frame_rate,nb_frames,color_space", "-of", "json", file],
+                                capture_output=True, text=True, check=True)
+        stream = json.loads(result.stdout)["streams"][0]
+    except (subprocess.CalledProcessError, ValueError, KeyError, IndexError):
+        return None
+
+    info = {}
+    if "width" in stream and "height" in stream:
+        info["width"] = int(stream["width"])
+        info["height"] = int(stream["height"])
+    if stream.get("r_frame_rate", "0/0").split("/")[-1] not in ("0", ""):
+        fps = fractions.Fraction(stream["r_frame_rate"])
+        info["fps_num"] = fps.numerator
+        info["fps_den"] = fps.denominator
+    if str(stream.get("nb_frames", "")).isdigit():
+        info["num_frames"] = int(stream["nb_frames"])
+    #streams without matrix coefficients are unspecified, same as in LWLibavSource
+    info["matrix"] = probe_matrix.get(stream.get("color_space"), 2)
+
+    return info
+
+#key of a file in the metadata cache. a file that's been changed or replaced gets a new key
+def probe_cache_key(file: str) -> str:
+    stat = os.stat(file)
+    return f"{os.path.abspath(file)}|{stat.st_mtime_ns}|{stat.st_size}"
+
+def probe_cache_path() -> str:
+    return os.path.join(get_cache_dir("metadata"), "metadata.json")
+
+def load_probe_cache() -> Dict[str, dict]:
+    global probe_cache
+
+    if probe_cache is None:
+        try:
+            with open(probe_cache_path()) as f:
+                probe_cache = json.load(f)
+        except (OSError, ValueError):
+            probe_cache = {}
+
+    return probe_cache
+
+#keep the metadata of a file for this run and write it to the metadata cache
+def save_source_info(file: str, info: dict):
+    source_info[file] = info
+    load_probe_cache()[probe_cache_key(file)] = info
+
+    #other processes may have added files since the cache was loaded, so their entries are kept
+    cache_path = probe_cache_path()
+    try:
+        with open(cache_path) as f:
+            probe_cache.update(json.load(f) | {probe_cache_key(file): info})
+    except (OSError, ValueError):
+        pass
+
+    with open(f"{cache_path}.{os.getpid()}.tmp", 'w') as f:
+        json.dump(probe_cache, f)
+    os.replace(f"{cache_path}.{os.getpid()}.tmp", cache_path)
+
+#get the metadata of a file: width, height, fps_num, fps_den, num_frames and matrix
+#comes from the metadata cache if the file was seen before, else from ffprobe. anything ffprobe can't tell is taken from the source
+def get_source_info(file: str) -> dict:
+    if file not in source_info:
+        info = load_probe_cache().get(probe_cache_key(file))
+
+        if info is not None:
+            source_info[file] = info
+        else:
+            info = probe_source(file) or {}
+
+            if any(name not in info for name in ("width", "height", "fps_num", "fps_den", "num_frames")):
+                clip = open_source(file)
+                info = {"width": clip.width, "height": clip.height} | info
+                #frame count and fps from the index are what the clip actually has, the ones in the headers aren't always
+                info |= {"fps_num": clip.fps_num, "fps_den": clip.fps_den, "num_frames": clip.num_frames}
+
+            if "matrix" not in info:
+                info["matrix"] = open_source(file).get_frame(0).props.get("_Matrix", 2)
+
+            save_source_info(file, info)
+
+    return source_info[file]
+
+#get the LWLibavSource of a file, opening it only the first time
+#the keyframes are read from the index before opening, so the file is only opened once. files that aren't indexed yet are opened with the default seek_threshold
+def open_source(file: str) -> vs.VideoNode:
+    if file not in sources:
+        #decode forward instead of seeking back to a keyframe when the next requested frame is at most one group of pictures ahead
+        keyframes = read_keyframes(file)
+        if keyframes is not None and keyframes.size > 1:
+            sources[file] = vs.core.lsmas.LWLibavSource(file, seek_threshold=int(np.diff(keyframes).max()))
+        else:
+            sources[file] = vs.core.lsmas.LWLibavSource(file)
+
+    return sources[file]
 
 #find video source with the highest resolution
 def get_highest_res(files: List[str]) -> int:
@@ -406,41 +1286,115 @@ def get_highest_res(files: List[str]) -> int:
     filenum = -1
     for f in files:
         filenum+=1
-        video = vs.core.lsmas.LWLibavSource(f)
-        if height < video.height:
-            height = video.height
-            width = video.width
+        video = get_source_info(f)
+        if height < video["height"]:
+            height = video["height"]
+            width = video["width"]
             max_res_file = filenum
 
     return width, height, max_res_file
 
 #get frames from a video source and appends them into one videonode
+#all frames are spliced at once, so the graph doesn't get one level deeper for every frame
 def get_frames(clip: vs.VideoNode, frames: List[int]) -> vs.VideoNode:
-    out = clip[frames[0]]
-    for i in frames[1:]:
-        out += clip[i]
-    return out
-
-#estimates time it would take to read a file
-#default size to read is 15 MB
-def estimate_read_time(file, chunk_size: int=15728640):
-    #make sure that we don't read more than the filesize
-    file_size = os.path.getsize(file)
-    if chunk_size >= file_size:
-        chunk_size = file_size - 1
-
-    start_time = time.time()
-    with open(file, 'rb') as f:
-        f.read(chunk_size)
-    elapsed_time = time.time() - start_time
+    if len(frames) == 1:
+        return clip[frames[0]]
+
+    return vs.core.std.Splice([clip[i] for i in frames])
+
+#read the frames of the first video stream from the index LWLibavSource saved next to a file, or None if there is no index
+#returns arrays of keyframe flags, picture types (as numbered by libavcodec) and timestamps, in decoding order
+@lru_cache
+def read_index(file: str) -> Optional[Dict[str, np.ndarray]]:
+    index_file = f"{file}.lwi"
+    if not os.path.exists(index_file):
+        return None
+
+    key = []
+    pic = []
+    pts = []
+    video_stream = None
+    stream = None
+    timestamp = None
+
+    with open(index_file, errors="ignore") as f:
+        for line in f:
+            if line.startswith("Index="):
+                fields = dict(field.split("=", 1) for field in line.strip().split(",") if "=" in field)
+                stream = int(fields["Index"])
+                timestamp = int(fields.get("PTS", "-9223372036854775808"))
+            #only the first video stream is used by LWLibavSource
+            elif line.startswith("Key="):
+                if video_stream is None:
+                    video_stream = stream
+                if stream == video_stream:
+                    fields = dict(field.split("=", 1) for field in line.strip().split(",") if "=" in field)
+                    key.append(fields["Key"] == "1")
+                    pic.append(int(fields.get("Pic", 0)))
+                    pts.append(timestamp)
+            elif line.startswith("</LibavReaderIndex"):
+                break
 
-    start_time = time.time()
-    with open(file, 'rb') as f:
-        f.read(chunk_size)
-    elapsed_time = (elapsed_time + time.time() - start_time)/2
+    if len(key) == 0:
+        return None
+
+    return {"key": np.array(key, dtype=bool), "pic": np.array(pic, dtype=np.int64), "pts": np.array(pts, dtype=np.int64)}
+
+#get the keyframes of a file from its index, or None if there is no index
+#the index lists frames in decoding order, which puts keyframes at almost the same place as in display order
+def read_keyframes(file: str) -> Optional[np.ndarray]:
+    index = read_index(file)
+    if index is None or not index["key"].any():
+        return None
+
+    return np.flatnonzero(index["key"])
+
+#get the picture type of every frame of a file in display order from its index, the same letters LWLibavSource puts in _PictType
+#returns None if there is no index or if it has frames without a timestamp, since those can't be put in display order
+def read_picture_types(file: str) -> Optional[np.ndarray]:
+    index = read_index(file)
+    if index is None or (index["pts"] == -9223372036854775808).any():
+        return None
+
+    #libavcodec numbers picture types starting at 1: I, P, B, S, i, p, b
+    letters = np.array(["?", "I", "P", "B", "S", "i", "p", "b"])
+    return letters[np.clip(index["pic"], 0, 7)][np.argsort(index["pts"], kind="stable")]
+
+#order in which frames of a clip made by init_clip should be requested to decode them fastest
+#frames are sorted by their source frame, so every group of pictures is sought once and frames inside it are decoded going forward
+def decode_order(frames: List[int], frame_map: np.ndarray) -> List[int]:
+    frames = np.asarray(frames, dtype=np.int64)
+    source_frames = np.where(frames < len(frame_map), frame_map[np.minimum(frames, len(frame_map) - 1)], frames)
+
+    return frames[np.argsort(source_frames, kind="stable")].tolist()
+
+#measure how many frames per second of a file can be decoded and measured the way lazylist does it
+#a few short runs of frames spread over the file are timed, so seeking to them is part of the result, like reading the file is for lazylist
+#the frames of a run are all requested at once, so the result is the throughput of Vapoursynth's threads and not the latency of one frame
+def decode_benchmark(file: str, runs: int = 4, run_length: int = 16) -> float:
+    clip = open_source(file).std.PlaneStats()
+    starts = [clip.num_frames * (i + 1) // (runs + 1) for i in range(runs)]
+
+    frame_count = 0
+    start_time = time.perf_counter()
+    for start in starts:
+        futures = [clip.get_frame_async(n) for n in range(start, min(start + run_length, clip.num_frames))]
+        for future in futures:
+            future.result()
+        frame_count += len(futures)
+    elapsed_time = time.perf_counter() - start_time
+
+    return frame_count / max(elapsed_time, 1e-6)
+
+#estimate how long analyzing every file would take, from its frame count and decoding speed
+#files are benchmarked one after another, so each one has every core to itself like it would when it's analyzed.
+#the results are kept in the metadata cache so later runs don't have to measure again
+def estimate_analysis_times(files: List[str]) -> List[float]:
+    for file in files:
+        if "decode_fps" not in get_source_info(file):
+            save_source_info(file, get_source_info(file) | {"decode_fps": decode_benchmark(file)})
 
-    estimated_time = (file_size / chunk_size) * elapsed_time
-    return estimated_time
+    return [get_source_info(file)["num_frames"] / get_source_info(file)["decode_fps"] for file in files]
 
 #determine which file should be analyzed in order to select frames
 def evaluate_analyze_clip(analyze_clip, files, files_info):
@@ -469,10 +1423,15 @@ def evaluate_analyze_clip(analyze_clip, files, files_info):
     else:
         file_analysis_default = True
 
-    #default: pick file with smallest read time
+    #default: pick a file which has already been analyzed, otherwise the file that can be analyzed fastest
+    if file_analysis_default and save_frames:
+        for file in files:
+            if has_source_stats(file, frame_count_motion > 0, motion_frames=frame_count_motion):
+                return file
+
     if file_analysis_default:
         print("Determining which file to analyze...\n")
-        estimated_times = [estimate_read_time(file) for file in files]
+        estimated_times = estimate_analysis_times(files)
         first_file = files[estimated_times.index(min(estimated_times))]
     
     return first_file
@@ -485,7 +1444,7 @@ def init_clip(file: str, files: list, trim_dict: dict, trim_dict_end: dict, chan
         file = evaluate_analyze_clip(analyze_clip, files, files_info)
 
     findex = files.index(file)
-    clip = vs.core.lsmas.LWLibavSource(file)
+    clip = open_source(file)
 
     if trim_dict.get(findex) is not None:
 
@@ -521,26 +1480,178 @@ def get_suffix(file: str, files: list, files_info: list):
 
     return suffix
 
-#convert a string to a float or int if possible
-def str_to_number(string: str):
-    try:
-        float(string)
-        try:
-            int(string)
-            return int(string)
-        except:
-            return float(string)
-    except:
-        return string
+#fast fingerprint of a video file, hashes its size and a few chunks spread over the file instead of reading all of it
+def file_fingerprint(file: str, chunk_size: int = 1048576, chunks: int = 8) -> str:
+    file_size = os.path.getsize(file)
+    file_hash = hashlib.blake2b(str(file_size).encode(), digest_size=16)
 
+    with open(file, 'rb') as f:
+        for i in range(chunks):
+            f.seek(max(0, file_size - chunk_size) * i // max(1, chunks - 1))
+            file_hash.update(f.read(chunk_size))
+
+    return file_hash.hexdigest()
+
+#directory in which data shared between runs is stored
+def get_cache_dir(subdir: str) -> str:
+    if cache_dirname != "":
+        base = cache_dirname
+    elif sys.platform == "win32":
+        base = os.path.join(os.environ.get("LOCALAPPDATA", os.path.expanduser("~")), "comp")
+    else:
+        base = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "comp")
+
+    path = os.path.join(base, subdir)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+#frame data cache layout: magic, version, header length, json header, padding to 8 bytes, then every array one after another
+frame_cache_magic = b"COMPFRMS"
+frame_cache_version = 2
+
+#write named per-frame arrays to a binary cache file
+def write_frame_cache(filename: str, header: dict, arrays: Dict[str, np.ndarray]):
+    header = dict(header, arrays={name: len(array) for name, array in arrays.items()})
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b" " * (-(len(frame_cache_magic) + 8 + len(header_bytes)) % 8)
+
+    #write next to the old file and swap it in, so an interrupted write never leaves a broken cache behind
+    with open(f"{filename}.{os.getpid()}.tmp", 'wb') as frame_file:
+        frame_file.write(frame_cache_magic)
+        frame_file.write(struct.pack("<II", frame_cache_version, len(header_bytes)))
+        frame_file.write(header_bytes)
+        for array in arrays.values():
+            frame_file.write(np.ascontiguousarray(array, dtype="<f8").tobytes())
+
+    os.replace(f"{filename}.{os.getpid()}.tmp", filename)
+
+#read a binary cache file, arrays are memory-mapped instead of read
+#returns None if the file doesn't exist or isn't a valid cache of the current version
+def read_frame_cache(filename: str):
+    if not os.path.exists(filename) or os.stat(filename).st_size == 0:
+        return None
+
+    with open(filename, 'rb') as frame_file:
+        if frame_file.read(len(frame_cache_magic)) != frame_cache_magic:
+            return None
+        version, header_len = struct.unpack("<II", frame_file.read(8))
+        if version != frame_cache_version:
+            return None
+        header = json.loads(frame_file.read(header_len))
+
+    offset = len(frame_cache_magic) + 8 + header_len
+    data = np.memmap(filename, dtype="<f8", mode="r", offset=offset, shape=(sum(header["arrays"].values()),))
+
+    arrays = {}
+    for name, length in header["arrays"].items():
+        arrays[name] = data[:length]
+        data = data[length:]
+
+    return header, arrays
+
+#path of the cached per-frame data of a video file, named after the fingerprint of its contents
+#data of proxy analysis and subsampled analysis is kept apart from full data
+#which frames subsampled analysis measures depends on the seed of the sampling offset and on how many places are refined for motion frames, so both are part of the name
+def source_stats_path(file: str, proxy: int = analysis_proxy, subsample: Union[int, str] = analysis_subsample, motion_frames: int = 0,
+                      seed: int = random_seed, diff_radius: int = motion_diff_radius) -> str:
+    name = file_fingerprint(file)
+
+    if proxy > 1:
+        name += f"_proxy{proxy}"
+    if subsample != 1:
+        name += f"_sub{subsample}_seed{seed}_motion{motion_frames}_radius{diff_radius}"
+
+    return os.path.join(get_cache_dir("stats"), name + ".compstats")
+
+#check if the data of a video file is already cached
+def has_source_stats(file: str, motion: bool = False, proxy: int = analysis_proxy, motion_frames: int = 0) -> bool:
+    cache = read_frame_cache(source_stats_path(file, proxy, motion_frames=motion_frames))
+    return cache is not None and (not motion or "motion" in cache[1])
+
+#get the per-frame data of the untrimmed video file, analyzing it first if it isn't cached yet
+#when only some frames are analyzed, frames around the best motion_frames places for motion frames are analyzed as well
+def get_source_stats(file: str, motion: bool = False, message: str = "Analyzing video", proxy: int = analysis_proxy, motion_frames: int = 0) -> Dict[str, np.ndarray]:
+    stats_path = source_stats_path(file, proxy, motion_frames=motion_frames)
+    cache = read_frame_cache(stats_path)
+
+    if cache is not None and (not motion or "motion" in cache[1]):
+        print(f'Reading brightness data of "{file}" from cache...\n')
+        return cache[1]
+
+    source = open_source(file)
+    avg, diff, _ = measure_clip(source, motion, message=message, proxy=proxy, keyframes=read_keyframes(file), motion_frames=motion_frames)
+
+    arrays = {"average": avg}
+    if motion:
+        arrays["motion"] = diff
+
+    write_frame_cache(stats_path, {"file_name": os.path.basename(file), "fps_num": source.fps_num, "fps_den": source.fps_den, "proxy": max(1, proxy), "subsample": analysis_subsample}, arrays)
+
+    return arrays
+
+#get the source frame of every frame of a clip made by init_clip. blank frames appended by negative trims are -1
+def source_frame_map(findex: int, source: vs.VideoNode, trim_dict: dict, trim_dict_end: dict, change_fps: dict = {}) -> np.ndarray:
+    frame_map = np.arange(source.num_frames, dtype=np.int64)
+
+    if trim_dict.get(findex) is not None:
+        if trim_dict.get(findex) > 0:
+            frame_map = frame_map[trim_dict.get(findex):]
+        elif trim_dict.get(findex) < 0:
+            frame_map = np.concatenate((np.full(trim_dict.get(findex) * -1, -1, dtype=np.int64), frame_map))
 
-def actual_script():
+    if trim_dict_end.get(findex) is not None:
+        frame_map = frame_map[:trim_dict_end.get(findex)]
+
+    #same frame selection as vstools.change_fps
+    if change_fps.get(findex) is not None:
+        factor = (change_fps.get(findex)[0] / change_fps.get(findex)[1]) * (source.fps_den / source.fps_num)
+        if factor != 1:
+            new_frames = np.arange(math.floor(len(frame_map) * factor))
+            frame_map = frame_map[np.minimum(np.rint(new_frames / factor).astype(np.int64), len(frame_map) - 1)]
+
+    return frame_map
+
+#pick the per-frame data of a clip out of the data of its source. blank frames have no brightness and no motion
+#motion is the difference to the previous frame, so it's only copied where the previous frame of the clip is also the previous frame of the source.
+#repeated frames have no motion, and the rest (the first frame of a trim, frames after dropped frames) are measured again on clip at 1/proxy of its resolution.
+#without clip they're left unknown (NaN), like frames subsampled analysis skipped
+def remap_stats(arrays: Dict[str, np.ndarray], frame_map: np.ndarray, motion: bool = False, clip: vs.VideoNode = None, proxy: int = analysis_proxy):
+    valid = frame_map >= 0
+    source_frames = np.where(valid, frame_map, 0)
+
+    avg = np.where(valid, arrays["average"][source_frames], 0.0)
+    if not motion:
+        return avg, np.zeros(0)
+
+    diff = np.where(valid, arrays["motion"][source_frames], 0.0)
+
+    #the frame before the first one is blank, same as the frame before the first frame of the source
+    previous = np.concatenate(([-1], frame_map[:-1]))
+    repeated = valid & (frame_map == previous)
+    diff[repeated] = 0.0
+    remeasure = np.flatnonzero(valid & ~repeated & (frame_map != previous + 1) & ~np.isnan(diff))
+
+    if remeasure.size > 0 and clip is not None:
+        print(f"Measuring motion of {remeasure.size} frame(s) at trims and fps changes...\n")
+        for n, _, motion_value, _ in analysis_stream(proxy_clip(clip, proxy), frame_numbers=remeasure, source=clip):
+            diff[n] = motion_value
+    else:
+        diff[remeasure] = np.nan
+
+    return avg, diff
+
+#make a comparison of the video files in the current directory, or of files if given
+#returns the slow.pics url, or None if nothing was uploaded
+def actual_script(files: List[str] = None, trim_dict: dict = trim_dict, trim_dict_end: dict = trim_dict_end, change_fps: dict = change_fps):
     global first_file
     first_file = None
+    #names are replaced by file indexes below, so work on copies. in batch mode every episode starts from the settings again
+    trim_dict, trim_dict_end, change_fps = copy.deepcopy((trim_dict, trim_dict_end, change_fps))
     #first file is only determined by analyze_clip if it is called 
 
     #find video files in the current directory, and exit if there are less than two
-    files = [file for file in os.listdir('.') if file.endswith(('.mkv', '.m2ts', '.mp4', '.webm'))]
+    if files is None:
+        files = [file for file in os.listdir('.') if file.endswith(video_extensions)]
     files = os_sorted(files)
     file_count = len(files)
     if file_count < 2:
@@ -581,6 +1692,16 @@ def actual_script():
     if anime_title == "":
         anime_title = collection_name
 
+    #if a previous upload of the same files was interrupted and its screenshots are still there, continue uploading them instead of starting over
+    journal = read_upload_journal()
+    screen_dir = pathlib.Path("./" + screen_dirname + "/")
+    if slowpics and can_resume_upload(journal, screen_dir, files):
+        resume_upload(screen_dir, journal)
+        return share_comparison(screen_dir, journal["key"])
+
+    #open every file once, indexing the ones that haven't been indexed yet at the same time
+    index_sources(files)
+
     #replace group or file names in trim_dict with file index
     for d in [trim_dict, trim_dict_end, change_fps]:
         for i in list(d):
@@ -598,8 +1719,8 @@ def actual_script():
         findex = list(change_fps.keys())[list(change_fps.values()).index("set")]
         del change_fps[findex]
         file = files[findex]
-        temp_clip = vs.core.lsmas.LWLibavSource(file)
-        fps = [temp_clip.fps_num, temp_clip.fps_den]
+        #fps of the opened clip, the one in the file headers can differ from it
+        fps = [open_source(file).fps_num, open_source(file).fps_den]
 
         for i in range(0, len(files)):
             if i not in change_fps:
@@ -607,9 +1728,9 @@ def actual_script():
 
     #if file is already set to certain fps, remove it from change_fps
     for findex, file in enumerate(files):
-        temp_clip = init_clip(file, files, trim_dict, trim_dict_end)
         if change_fps.get(findex) is not None:
-            if temp_clip.fps_num / temp_clip.fps_den == change_fps.get(findex)[0] / change_fps.get(findex)[1]:
+            source = open_source(file)
+            if source.fps_num / source.fps_den == change_fps.get(findex)[0] / change_fps.get(findex)[1]:
                 del change_fps[findex]
 
     #print list of files
@@ -650,117 +1771,35 @@ def actual_script():
 
     frames = []
 
-    #if save_frames is enabled, store generated brightness data in a text file, so they don't have to be analyzed again
-    if save_frames and (frame_count_dark + frame_count_bright + frame_count_motion) > 0:
-        mismatch = False
-        #if frame file exists, read from it
-        if os.path.exists(frame_filename) and os.stat(frame_filename).st_size > 0:
+    if (frame_count_dark + frame_count_bright + frame_count_motion) > 0:
+        first, first_file = init_clip(first_file, files, trim_dict, trim_dict_end, change_fps, analyze_clip, files_info, return_file=True)
+        stats = None
+        keyframes = None
+        frame_map = source_frame_map(files.index(first_file), open_source(first_file), trim_dict, trim_dict_end, change_fps)
 
-            print(f'Reading data from "{frame_filename}"...')
-            with open(frame_filename) as frame_file:
-                generated_frames = frame_file.readlines()
+        #keyframes of the source, moved to where they are in the trimmed clip
+        if read_keyframes(first_file) is not None and len(frame_map) == first.num_frames:
+            keyframes = np.flatnonzero(np.isin(frame_map, read_keyframes(first_file)))
 
-            #turn numbers into floats or ints, and get rid of newlines
-            for i, v in enumerate(generated_frames):
-                v = v.strip()
-                generated_frames[i] = str_to_number(v)
-            
-            dark_list = generated_frames[generated_frames.index("dark:")+1:generated_frames.index("bright:")]
-            light_list = generated_frames[generated_frames.index("bright:")+1:generated_frames.index("motion:")]
-            motion_list = generated_frames[generated_frames.index("motion:")+1:]
-
-            analyzed_file = generated_frames[generated_frames.index("analyzed_file:") + 1]
-            analyzed_group = ani.parse(analyzed_file).get("release_group")
-            file_trim = generated_frames[generated_frames.index("analyzed_file_trim:") + 1]
-            file_trim_end = generated_frames[generated_frames.index("analyzed_file_trim:") + 2]
-            file_fps_num = generated_frames[generated_frames.index("analyzed_file_fps:") + 1]
-            file_fps_den = generated_frames[generated_frames.index("analyzed_file_fps:") + 2]
-
-            #check if a file with the same group name as the analyzed file is present in our current directory
-            group_found = False
-            for i, dict in enumerate(files_info):
-                if dict.get("release_group").lower() == analyzed_group.lower():
-                    group_found = True
-                    group_file_index = files.index(dict.get("file_name"))
-            
-            #if file wasn't found but group name was, set file with the same group name
-            if analyzed_file not in files and group_found is True:
-                analyzed_file = files[group_file_index]
-
-            #check if show name, episode number, or the release which was analyzed has changed
-            if (generated_frames[generated_frames.index("show_name:") + 1] != anime_title
-                or generated_frames[generated_frames.index("episode_num:") + 1] != int(anime_episode_number)
-                or analyzed_file not in files):
-
-                mismatch = True
-
-            #check if trim for analyzed file has changed
-            if mismatch == False:
-                found_trim = 0
-                found_trim_end = 0
-                if files.index(analyzed_file) in trim_dict:
-                    found_trim = trim_dict.get(files.index(analyzed_file))
-                if files.index(analyzed_file) in trim_dict_end:
-                    found_trim_end = trim_dict_end.get(files.index(analyzed_file))
-
-                if (file_trim != found_trim
-                    or file_trim_end != found_trim_end):
-                    mismatch = True
-
-            #check if fps of analyzed file has changed
-            if mismatch == False:
-                temp_clip = init_clip(analyzed_file, files, trim_dict, trim_dict_end, change_fps)
-                if file_fps_num / file_fps_den != temp_clip.fps_num / temp_clip.fps_den:
-                    mismatch = True
-
-
-            #if mismatch is detected, re-analyze frames
-            if mismatch:
-                print("\nParameters have changed. Will re-analyze brightness data.\n")
-                os.remove(frame_filename)
-
-            #only spend time processing lazylist if we need to
-            elif (frame_count_dark + frame_count_bright + frame_count_motion) > 0:
-                clip = init_clip(files[0], files, trim_dict, trim_dict_end, change_fps, analyze_clip, files_info)
-                frames.extend(lazylist(clip, frame_count_dark, frame_count_bright, frame_count_motion, dark_list=dark_list, light_list=light_list, motion_list=motion_list, file=files[0], files=files, files_info=files_info))
-
-        #if frame file does not exist or has less frames than specified, write to it
-        if not os.path.exists(frame_filename) or os.stat(frame_filename).st_size == 0 or mismatch:
-
-            #if this is the first time first_file is being called, it will be evaluated. if not, it will already be known, since it's a global variable
-            first, first_file = init_clip(first_file, files, trim_dict, trim_dict_end, change_fps, analyze_clip, files_info, return_file=True)
-
-            #get the trim
-            first_trim = 0
-            first_trim_end = 0
-            if files.index(first_file) in trim_dict:
-                first_trim = trim_dict[files.index(first_file)]
-            if files.index(first_file) in trim_dict_end:
-                first_trim_end = trim_dict_end[files.index(first_file)]
-
-
-            frames_temp, dark_list, light_list, motion_list = lazylist(first, frame_count_dark, frame_count_bright, frame_count_motion, save_frames=True, file=first_file, files=files, files_info=files_info)
-            frames.extend(frames_temp)
-            
-            with open(frame_filename, 'w') as frame_file:
+        #if save_frames is enabled, use the cached data of the source and apply trims and fps changes to it, so nothing has to be analyzed again
+        if save_frames:
+            arrays = get_source_stats(first_file, frame_count_motion > 0, analysis_message(first_file, files, files_info), motion_frames=frame_count_motion)
 
-                frame_file.write(f"show_name:\n{anime_title}\nepisode_num:\n{anime_episode_number}\nanalyzed_file:\n{first_file}\nanalyzed_file_trim:\n{first_trim}\n{first_trim_end}\nanalyzed_file_fps:\n{first.fps_num}\n{first.fps_den}\ndark:\n")
-                for val in dark_list:
-                    frame_file.write(f"{val}\n")
+            if len(frame_map) == first.num_frames:
+                stats = remap_stats(arrays, frame_map, frame_count_motion > 0, first)
+            else:
+                print("Could not map cached data onto the trimmed clip. Will analyze the trimmed clip instead.\n")
 
-                frame_file.write("bright:\n")
-                for val in light_list:
-                    frame_file.write(f"{val}\n")
+        selected, stats = lazylist(first, frame_count_dark, frame_count_bright, frame_count_motion, stats=stats, save_frames=True, file=first_file, files=files, files_info=files_info, keyframes=keyframes)
+        frames.extend(selected)
 
-                frame_file.write("motion:\n")
-                for val in motion_list:
-                    frame_file.write(f"{val}\n")
+        #compare the selection to the one full resolution analysis makes
+        if analysis_proxy > 1 and validate_proxy:
+            full_stats = None
+            if save_frames and len(frame_map) == first.num_frames:
+                full_stats = remap_stats(get_source_stats(first_file, frame_count_motion > 0, analysis_message(first_file, files, files_info), proxy=1, motion_frames=frame_count_motion), frame_map, frame_count_motion > 0, first, proxy=1)
 
-    
-    #if save_frames isn't enabled, run lazylist
-    elif (frame_count_dark + frame_count_bright + frame_count_motion) > 0:
-        first, first_file = init_clip(first_file, files, trim_dict, trim_dict_end, change_fps, analyze_clip, files_info, return_file=True)
-        frames.extend(lazylist(first, frame_count_dark, frame_count_bright, frame_count_motion, file=first_file, files=files, files_info=files_info))
+            validate_proxy_selection(first, selected, stats, full_stats, file=first_file, files=files, files_info=files_info, keyframes=keyframes)
 
     if random_frames > 0:
 
@@ -801,7 +1840,7 @@ def actual_script():
             message+=", "
         first = False
         message+=str(f)
-    print(textwrap.fill(message, os.get_terminal_size().columns), end="\n\n")
+    print(textwrap.fill(message, shutil.get_terminal_size().columns), end="\n\n")
 
     if upscale:
         max_width, max_height, max_res_file = get_highest_res(files)
@@ -812,38 +1851,78 @@ def actual_script():
         shutil.rmtree(screen_dir)
     os.mkdir(screen_dir)
 
+    #get release group or filename of every file
+    #any characters not suited for filepath are removed
+    suffixes = [get_suffix(file, files, files_info).replace("[\\/:\"*?<>|]+", "").strip() for file in files]
+
+    #create the comparison before making any screenshots, so every screenshot can be uploaded as soon as it's saved
+    if slowpics:
+        sess = slowpics_session()
+        journal = create_comparison(sess, frames, suffixes, collection_name, files)
+        upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=upload_workers)
+        uploads = []
+
     print("Generating screenshots:")
     #initialize progress bar, specify information to be output
     #would use expand=True but the lazylist progress bar doesn't so i'd rather go for consistency
-    with Progress(TextColumn("{task.description}"), BarColumn(), TextColumn("{task.completed}/{task.total}"), TextColumn("{task.percentage:>3.02f}%"), TimeRemainingColumn()) as progress:
+    with trace_stage("rendering", frames=len(frames) * len(files)), \
+         Progress(TextColumn("{task.description}"), BarColumn(), TextColumn("{task.completed}/{task.total}"), TextColumn("{task.percentage:>3.02f}%"), TimeRemainingColumn()) as progress:
 
         total_gen_progress = progress.add_task("[green]Total", total=len(frames) * len(files))
-        file_gen_progress = progress.add_task("", total=len(frames), visible=0)
+        writers = []
+        writer_progress = []
+        writer_suffixes = []
+        writer_orders = []
+        ffmpeg_jobs = []
+        png_nodes = []
+        png_suffixes = []
+        png_progress = []
+        png_orders = []
+        on_saved = None
+        #every file has exactly one output node, in the same order as files
+        source_nodes = [open_source(file) for file in files]
+
+        if slowpics:
+            upload_progress = progress.add_task("[bright_magenta]Uploading to Slowpoke Pics", total=len(frames) * len(files))
+
+            #the bar only counts screenshots that were uploaded, failed ones are reported once all uploads are done
+            def upload_done(future: concurrent.futures.Future):
+                if future.exception() is None:
+                    progress.update(upload_progress, advance=1)
+
+            def on_saved(image_file: str):
+                future = upload_executor.submit(upload_image, sess, journal, screen_dir, image_file)
+                future.add_done_callback(upload_done)
+                uploads.append((image_file, future))
 
         for file in files:
             findex = files.index(file)
             extended = 0
             clip = init_clip(file, files, trim_dict, trim_dict_end, change_fps)
+            #request frames in the order they are stored in the file
+            frame_map = source_frame_map(findex, open_source(file), trim_dict, trim_dict_end, change_fps)
+            order = decode_order(frames, frame_map)
+
+            #account for negative trim "extensions"
+            if trim_dict.get(findex) is not None and trim_dict.get(findex) < 0:
+                extended = trim_dict.get(findex) * -1
+
+            suffix = suffixes[findex]
 
-            #get release group or filename of file
-            suffix = get_suffix(file, files, files_info)
-            #remove any characters not suited for filepath
-            suffix = suffix.replace("[\\/:\"*?<>|]+", "").strip()
+            #if frame_info option selected, print frame info on the selected frames once they're converted to RGB
+            overlay = None
+            if frame_info:
+                overlay = partial(frame_info_overlay, title=suffix, frame_numbers=frames, picture_types=clip_picture_types(file, frame_map, frames))
 
             if suffix == files_info[files.index(file)].get("file_name"):
                 message = f'[yellow]{suffix}'
             else:
                 message = f'[cyan]{suffix}'
-            progress.reset(file_gen_progress, description=message, visible=1)
+            file_gen_progress = progress.add_task(message, total=len(frames))
 
-            if ffmpeg:
-                import subprocess
-                
-                #get matrix of clip, account for negative trim "extensions"
-                if trim_dict.get(findex) is not None and trim_dict.get(findex) < 0:
-                    matrix = clip.get_frame(trim_dict.get(findex) * -1).props._Matrix
-                else:
-                    matrix = clip.get_frame(0).props._Matrix
+            if ffmpeg or python_png:
+                #get matrix of clip
+                matrix = get_source_info(file)["matrix"]
 
                 if matrix == 2:
                     matrix = 1
@@ -856,32 +1935,19 @@ def actual_script():
                 else:
                     clip = clip.resize.Spline36(format=vs.RGB24, matrix_in=matrix, dither_type="error_diffusion")
 
-                #if frame_info option selected, print frame info to screen
-                if frame_info:
-                    clip = FrameInfo(clip, title=suffix)
+                if overlay is not None:
+                    clip = overlay(clip)
                 
-                #get a clip with only the desired frames appended to one another
-                clip = get_frames(clip, frames)
-                clip = clip.std.ShufflePlanes([1, 2, 0], vs.RGB).std.AssumeFPS(fpsnum=1, fpsden=1)
-
-                path_images = [
-                    f"{screen_dir}/{f} - {suffix}.png"
-                    for f in frames
-                ]
-
-                #generate screens with ffmpeg
-                for i, path_image in enumerate(path_images):
-
-                    ffmpeg_line = f"ffmpeg -y -hide_banner -loglevel error -f rawvideo -video_size {clip.width}x{clip.height} -pixel_format gbrp -framerate {str(clip.fps)} -i pipe: -pred mixed -ss {i} -t 1 \"{path_image}\""
-                    try:
-                        with subprocess.Popen(ffmpeg_line, stdin=subprocess.PIPE) as process:
-                            clip.output(cast(BinaryIO, process.stdin), y4m=False)
-                    except:
-                        None
-                    
-                    progress.update(total_gen_progress, advance=1)
-                    progress.update(file_gen_progress, advance=1)
+                if python_png:
+                    png_nodes.append(clip)
+                    png_suffixes.append(suffix)
+                    png_progress.append(file_gen_progress)
+                    png_orders.append(order)
+                else:
+                    #get a clip with only the desired frames appended to one another
+                    clip = get_frames(clip, order)
 
+                    ffmpeg_jobs.append((clip, order, suffix, file_gen_progress))
 
             else:
                 #upscale depending on options selected
@@ -890,112 +1956,168 @@ def actual_script():
                 elif upscale and clip.height != max_height:
                     clip = vs.core.resize.Spline36(clip, int(round(clip.width * (max_height / clip.height), 0)), max_height, dither_type="error_diffusion")
 
-                #if frame_info option selected, print frame info to screen
-                if frame_info:
-                    clip = FrameInfo(clip, title=suffix)
-
-                screengen(progress, total_gen_progress, file_gen_progress, clip, screen_dirname, suffix, frames, extended)
+                writers.append(screen_writer(clip, screen_dir, suffix, extended, get_source_info(file)["matrix"], overlay))
+                writer_progress.append(file_gen_progress)
+                writer_suffixes.append(suffix)
+                writer_orders.append(order)
+
+        #render the screenshots of every file at the same time
+        if len(writers) > 0:
+
+            def on_frame(i: int, num: int, frame: vs.VideoFrame):
+                progress.update(total_gen_progress, advance=1)
+                progress.update(writer_progress[i], advance=1)
+
+                #imwri has saved the image by the time its frame is returned
+                if on_saved is not None:
+                    on_saved(f"{num} - {writer_suffixes[i]}.png")
+
+            with govern_memory(writers, source_nodes) as max_requests:
+                render_screens(writers, frames, progress, total_gen_progress, writer_progress, max_requests, on_frame, writer_orders)
+
+        if len(png_nodes) > 0:
+            with govern_memory(png_nodes, source_nodes) as max_requests:
+                png_screens(png_nodes, png_suffixes, frames, screen_dir, progress, total_gen_progress, png_progress, on_saved, png_orders, max_requests)
+
+        #run one ffmpeg process per file, all files at the same time
+        if len(ffmpeg_jobs) > 0:
+            with govern_memory([job[0] for job in ffmpeg_jobs], source_nodes) as max_requests, \
+                 concurrent.futures.ThreadPoolExecutor(max_workers=len(ffmpeg_jobs)) as executor:
+                prefetch = max(1, max_requests // len(ffmpeg_jobs))
+                futures = [executor.submit(ffmpeg_screens, clip, order, screen_dir, suffix, progress, total_gen_progress, file_gen_progress, prefetch, on_saved) for clip, order, suffix, file_gen_progress in ffmpeg_jobs]
+                for future in futures:
+                    future.result()
+
+        #finish the uploads that are still running
+        if slowpics:
+            with trace_stage("upload wait", images=len(uploads)):
+                upload_executor.shutdown()
+                sess.close()
+                failed = [(image_file, future.exception()) for image_file, future in uploads if future.exception() is not None]
 
     print()
 
     if slowpics:
-        #time.sleep(0.5)
-
-        browserId = str(uuid.uuid4())
-        fields: Dict[str, Any] = {
-            'collectionName': collection_name,
-            'hentai': str(hentai_flag).lower(),
-            'optimize-images': 'true',
-            'browserId': browserId,
-            'public': str(public_flag).lower()
-        }
-
-        if tmdbID != "":
-            fields |= {'tmdbId': str(tmdbID)}
-        if remove_after != "" and remove_after != 0:
-            fields |= {'removeAfter': str(remove_after)}
-
-        all_image_files = os_sorted([f for f in os.listdir(screen_dir) if f.endswith('.png')])
-
-        #check if all image files are present before uploading. if not, wait a bit and check again. if still not, exit program
-        if len(all_image_files) < len(frames) * len(files):
-            time.sleep(5)
-            all_image_files = os_sorted([f for f in os.listdir(screen_dir) if f.endswith('.png')])
-
-            if len(all_image_files) < len(frames) * len(files):
-                sys.exit(f'ERROR: Number of screenshots in "{screen_dirname}" folder does not match expected value.')
-        
-        for x in range(0, len(frames)):
-            #current_comp is list of image files for this frame
-            current_comp = [f for f in all_image_files if f.startswith(str(frames[x]) + " - ")]
-            #add field for comparison name. after every comparison name there needs to be as many image names as there are comped video files
-            fields[f'comparisons[{x}].name'] = str(frames[x])
-            #iterate over the image files for this frame
-            for imageName in current_comp:
-                i = current_comp.index(imageName)
-                image = pathlib.Path(f"{screen_dir}/{imageName}")
-                fields[f'comparisons[{x}].imageNames[{i}]'] = os.path.basename(image.name).split(' - ', 1)[1].replace(".png", "")
-                ##this would upload the images all at once, but that wouldnt let us get progress
-                #fields[f'comparisons[{x}].images[{i}].file'] = (image.name.split(' - ', 1)[1].replace(".png", ""), image.read_bytes(), 'image/png')
-
-        with Session() as sess:
-            sess.get('https://slow.pics/comparison')
-
-            files = MultipartEncoder(fields, str(uuid.uuid4()))
-
-            comp_req = sess.post(
-                'https://slow.pics/upload/comparison', data=files.to_string(),
-                headers=_get_slowpics_header(str(files.len), files.content_type, sess)
-            )
-
-            comp_response = comp_req.json()
-
-            collection = comp_response["collectionUuid"]
-            key = comp_response["key"]
-
-            #print("\n", comp_response["images"])
-            with Progress(TextColumn("{task.description}"), BarColumn(), TextColumn("{task.completed}/{task.total}"), TextColumn("{task.percentage:>3.02f}%"), TimeRemainingColumn()) as progress:
-                upload_progress = progress.add_task("[bright_magenta]Uploading to Slowpoke Pics", total=len(all_image_files))
-
-                for index, image_section in enumerate(comp_response["images"]):
-                    base = index * file_count
-                    for image_index, image_id in enumerate(image_section):
-
-                        #print("\nbase:", base, "\nimage_index:", image_index)
-                        upload_info = {
-                            "collectionUuid": collection,
-                            "imageUuid": image_id,
-                            "file": (all_image_files[base + image_index], pathlib.Path(f"{screen_dir}/{all_image_files[base + image_index]}").read_bytes(), 'image/png'),
-                            'browserId': browserId,
-                        }
-                        upload_info = MultipartEncoder(upload_info, str(uuid.uuid4()))
-                        upload_response = sess.post(
-                            'https://slow.pics/upload/image', data=upload_info.to_string(),
-                            headers=_get_slowpics_header(str(upload_info.len), upload_info.content_type, sess)
-                        )
-
-                        progress.update(upload_progress, advance=1)
-
-                        assert upload_response.status_code == 200, "Status code not 200"
-                        assert upload_response.content.decode() == "OK", "Content not OK"
-
-        slowpics_url = f'https://slow.pics/c/{key}'
-        print(f'\nSlowpoke Pics url: {slowpics_url}', end='')
-        pc.copy(slowpics_url)
-
-        if browser_open:
-            webbrowser.open(slowpics_url)
-
-        if webhook_url:
-            data = {"content": slowpics_url}
-            if requests.post(webhook_url, data).status_code < 300:
-                print('Posted to webhook.')
+        report_failed_uploads(failed)
+        os.remove(upload_journal_filename)
+        return share_comparison(screen_dir, journal["key"])
+
+video_extensions = ('.mkv', '.m2ts', '.mp4', '.webm')
+
+#find the episodes to comp in batch mode, as (folder, files) pairs. files is None when every video file in the folder is used
+#path can be a directory, in which every folder with at least two video files is an episode,
+#or a json manifest with a list of folders, or of {"folder": ..., "files": [...]} objects. paths in a manifest are relative to it
+def find_episodes(path: str) -> List[tuple]:
+    episodes = []
+
+    if os.path.isfile(path):
+        with open(path) as f:
+            manifest = json.load(f)
+
+        base = os.path.dirname(os.path.abspath(path))
+        for entry in manifest:
+            if isinstance(entry, str):
+                episodes.append((os.path.join(base, entry), None))
             else:
-                print('Failed to post on webhook!')
-
-        if delete_screen_dir and os.path.isdir(screen_dir):
-            shutil.rmtree(screen_dir)
+                episodes.append((os.path.join(base, entry["folder"]), entry.get("files")))
 
-        time.sleep(3)
-
-actual_script()
+    else:
+        for folder, _, filenames in os.walk(path):
+            if len([f for f in filenames if f.endswith(video_extensions)]) >= 2:
+                episodes.append((os.path.abspath(folder), None))
+
+    return os_sorted(episodes, key=lambda episode: episode[0])
+
+#set in batch worker processes, see _init_batch_worker
+batch_worker = False
+
+#runs once in every batch worker process. memory and threads are split between the workers
+def _init_batch_worker(workers: int):
+    global ram_limit, interactive, core_threads, batch_worker
+    interactive = False
+    batch_worker = True
+    ram_limit = max(1, ram_limit // workers)
+    core_threads = max(1, (os.cpu_count() or 1) // workers)
+    vs.core.max_cache_size = ram_limit
+    vs.core.num_threads = core_threads
+
+#comp one episode in a batch worker. everything that would be printed goes to comp.log in the episode folder
+def comp_episode(folder: str, files: List[str] = None) -> dict:
+    global trace_file
+
+    os.chdir(folder)
+
+    #file names are relative to the episode folder, so nothing opened for an earlier episode can be used
+    sources.clear()
+    source_info.clear()
+    read_index.cache_clear()
+    trace_events.clear()
+    if trace_file != "":
+        trace_file = os.path.join(folder, os.path.basename(trace_file))
+
+    with open("comp.log", 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            return {"folder": folder, "url": actual_script(files)}
+        except SystemExit as e:
+            return {"folder": folder, "error": str(e)}
+        except Exception as e:
+            traceback.print_exc()
+            return {"folder": folder, "error": repr(e)}
+        finally:
+            write_trace()
+
+#the video files of a batch episode, with absolute paths
+def episode_files(folder: str, files: List[str] = None) -> List[str]:
+    if files is None:
+        files = [file for file in os.listdir(folder) if file.endswith(video_extensions)]
+    return [os.path.join(folder, file) for file in files]
+
+#comp many episodes at once, each one in a worker process. returns the result of every episode, see comp_episode
+#the files that aren't indexed yet are indexed first, in the same pool, so the workers don't each start a pool of their own
+def run_batch(episodes: List[tuple], workers: int = None) -> List[dict]:
+    if workers is None:
+        workers = max(1, min(len(episodes), (os.cpu_count() or 1) // 4))
+
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_batch_worker, initargs=(workers,)) as executor:
+        new_files = [file for folder, files in episodes for file in episode_files(folder, files) if not os.path.exists(f"{file}.lwi")]
+        if len(new_files) > 0:
+            print(f"Indexing {len(new_files)} file{'s' if len(new_files) > 1 else ''}...")
+            indexing = {executor.submit(_index_source, file): file for file in new_files}
+            for future in concurrent.futures.as_completed(indexing):
+                #a file that can't be indexed fails its episode later, with the error in its comp.log
+                if future.exception() is None:
+                    save_source_info(indexing[future], future.result())
+
+        futures = [executor.submit(comp_episode, folder, files) for folder, files in episodes]
+
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(f'{result["folder"]}: {result.get("url") or result.get("error") or "done"}')
+
+    return results
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Make a comparison of the video files in the current directory.")
+    parser.add_argument("--batch", "-b", dest="batch", type=str, default=None,
+                        help="Comp every episode in this directory tree or json manifest instead, without any interactive steps")
+    parser.add_argument("--workers", "-w", dest="workers", type=int, default=None,
+                        help="Number of episodes comped at the same time in batch mode")
+    args = parser.parse_args()
+
+    if args.batch is not None:
+        episodes = find_episodes(args.batch)
+        if len(episodes) == 0:
+            sys.exit("No episodes found.")
+        results = run_batch(episodes, args.workers)
+        failed = [result for result in results if "error" in result]
+        if len(failed) > 0:
+            sys.exit(f"{len(failed)} of {len(results)} episodes failed.")
+    else:
+        try:
+            actual_script()
+        finally:
+            write_trace()
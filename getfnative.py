@@ -2,17 +2,30 @@ from __future__ import annotations
 
 import argparse
 import gc
+import hashlib
 import os
 import runpy
+import sys
+import threading
 import time
-from functools import partial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
 from math import floor
-from typing import Callable, Optional, Union
+from types import SimpleNamespace
+from typing import Callable, Optional, Sequence, Union
 
 import matplotlib.pyplot as plt
+import numpy as np
 import vapoursynth as vs
 from matplotlib.figure import figaspect
 
+try:
+    from scipy import sparse
+    from scipy.linalg import cholesky_banded
+except ImportError:
+    sparse = cholesky_banded = None
+
 core = vs.core
 
 __all__ = ['descale_cropping_args']
@@ -104,12 +117,474 @@ def descale_cropping_args(clip: vs.VideoNode, # letterbox-free source clip
     return args
 
 
+def descale_error_node(clip: vs.VideoNode,
+                       src_height: float,
+                       base_height: int,
+                       base_width: int,
+                       crop_top: int = 0,
+                       crop_bottom: int = 0,
+                       crop_left: int = 0,
+                       crop_right: int = 0,
+                       kernel: str = 'bicubic',
+                       b: int = 0,
+                       c: float = 1 / 2,
+                       taps: int = 3,
+                       mode: str = 'wh',
+                       thr: float = 0.015
+                       ) -> vs.VideoNode:
+    # clip is a single GRAYS frame, the error ends up in PlaneStatsAverage
+    cropping_args = descale_cropping_args(
+        clip, src_height, base_height, base_width, crop_top, crop_bottom, crop_left, crop_right, mode)
+    descaled = core.descale.Descale(clip, kernel=kernel, b=b, c=c, taps=taps, **cropping_args)
+    cropping_args.update(width=clip.width, height=clip.height)
+    rescaled = get_scaler(kernel, b, c, taps)(descaled, **cropping_args)
+    diff = core.std.Expr([clip, rescaled], f'x y - abs dup {thr} > swap 0 ?')
+    return diff.std.Crop(10, 10, 10, 10).std.PlaneStats()
+
+
+def kernel_weights(kernel: str,
+                   b: int = 0,
+                   c: float = 1 / 2,
+                   taps: int = 3
+                   ) -> tuple[Callable[[np.ndarray], np.ndarray], int]:
+    # Same kernels and supports as descale and zimg
+    if kernel == 'bilinear':
+        return lambda x: np.maximum(1 - np.abs(x), 0), 1
+    elif kernel == 'bicubic':
+        def _bicubic(x: np.ndarray) -> np.ndarray:
+            x = np.abs(x)
+            near = ((12 - 9 * b - 6 * c) * x ** 3 + (-18 + 12 * b + 6 * c) * x ** 2 + (6 - 2 * b)) / 6
+            far = ((-b - 6 * c) * x ** 3 + (6 * b + 30 * c) * x ** 2 + (-12 * b - 48 * c) * x + (8 * b + 24 * c)) / 6
+            return np.where(x < 1, near, np.where(x < 2, far, 0))
+        return _bicubic, 2
+    elif kernel == 'lanczos':
+        return lambda x: np.where(np.abs(x) < taps, np.sinc(x) * np.sinc(x / taps), 0), taps
+    elif kernel in {'spline16', 'spline36', 'spline64'}:
+        # Cubic pieces on [0, 1), [1, 2), ..., evaluated at the distance from the start of each piece
+        pieces = {
+            'spline16': [(1, -9 / 5, -1 / 5, 1), (-1 / 3, 4 / 5, -7 / 15, 0)],
+            'spline36': [(13 / 11, -453 / 209, -3 / 209, 1), (-6 / 11, 270 / 209, -156 / 209, 0),
+                         (1 / 11, -45 / 209, 26 / 209, 0)],
+            'spline64': [(49 / 41, -6387 / 2911, -3 / 2911, 1), (-24 / 41, 4032 / 2911, -2328 / 2911, 0),
+                         (6 / 41, -1008 / 2911, 582 / 2911, 0), (-1 / 41, 168 / 2911, -97 / 2911, 0)],
+        }[kernel]
+
+        def _spline(x: np.ndarray) -> np.ndarray:
+            x = np.abs(x)
+            piece = np.minimum(np.floor(x), len(pieces) - 1).astype(int)
+            t = x - piece
+            coeffs = np.array(pieces)[piece]
+            y = ((coeffs[..., 0] * t + coeffs[..., 1]) * t + coeffs[..., 2]) * t + coeffs[..., 3]
+            return np.where(x < len(pieces), y, 0)
+        return _spline, len(pieces)
+    else:
+        raise ValueError('kernel_weights: invalid kernel specified.')
+
+
+def scaling_weights(kernel: str,
+                    b: int,
+                    c: float,
+                    taps: int,
+                    src_dim: int,
+                    dst_dim: int,
+                    shift: float = 0.0,
+                    active_dim: Optional[float] = None
+                    ) -> tuple[np.ndarray, np.ndarray]:
+    # Upscaling from src_dim to dst_dim, mirrored at the borders like descale.
+    # Row i of the dst_dim x src_dim matrix has the weights w[i] at the columns idx[i]
+    if active_dim is None:
+        active_dim = src_dim
+    weight, support = kernel_weights(kernel, b, c, taps)
+    ratio = dst_dim / active_dim
+
+    pos = (np.arange(dst_dim) + 0.5) / ratio + shift
+    begin_pos = np.floor(pos - support + 0.5) + 0.5
+    xpos = begin_pos[:, None] + np.arange(2 * support)
+    w = weight(xpos - pos[:, None])
+    w /= w.sum(axis=1, keepdims=True)
+
+    real_pos = np.where(xpos < 0, -xpos, np.where(xpos >= src_dim, 2 * src_dim - xpos, xpos))
+    idx = np.clip(np.floor(real_pos).astype(np.intp), 0, src_dim - 1)
+    return idx, w
+
+
+def weights_matrix(idx: np.ndarray, w: np.ndarray, src_dim: int):
+    # Sparse with SciPy, dense otherwise
+    rows = np.repeat(np.arange(idx.shape[0]), idx.shape[1])
+    if sparse is not None:
+        return sparse.csr_matrix((w.ravel(), (rows, idx.ravel())), shape=(idx.shape[0], src_dim), dtype=np.float32)
+    matrix = np.zeros((idx.shape[0], src_dim))
+    np.add.at(matrix, (rows, idx.ravel()), w.ravel())
+    return matrix.astype(np.float32)
+
+
+def normal_banded(idx: np.ndarray, w: np.ndarray, src_dim: int) -> np.ndarray:
+    # Upper band of weights.T @ weights, in the layout of scipy.linalg.cholesky_banded
+    bandwidth = int((idx.max(axis=1) - idx.min(axis=1)).max())
+    banded = np.zeros((bandwidth + 1) * src_dim)
+    for t in range(idx.shape[1]):
+        for s in range(idx.shape[1]):
+            upper = idx[:, t] <= idx[:, s]
+            pos = (bandwidth + idx[upper, t] - idx[upper, s]) * src_dim + idx[upper, s]
+            banded += np.bincount(pos, (w[upper, t] * w[upper, s]), minlength=banded.size)
+    return banded.reshape(bandwidth + 1, src_dim)
+
+
+def banded_cholesky(banded: np.ndarray) -> np.ndarray:
+    # Upper factor U with U.T @ U equal to the banded matrix, same layout
+    if cholesky_banded is not None:
+        return cholesky_banded(banded, check_finite=False)
+    u, n = banded.shape[0] - 1, banded.shape[1]
+    factor = np.zeros_like(banded)
+    for j in range(n):
+        for i in range(max(0, j - u), j + 1):
+            s = banded[u + i - j, j] - sum(factor[u + k - i, i] * factor[u + k - j, j] for k in range(max(0, j - u), i))
+            if i == j and not s > 0:
+                raise np.linalg.LinAlgError('banded_cholesky: matrix is not positive definite.')
+            factor[u + i - j, j] = np.sqrt(s) if i == j else s / factor[u, i]
+    return factor
+
+
+def banded_solve(factor: np.ndarray, rhs: np.ndarray) -> np.ndarray:
+    # Solves U.T @ U @ x = rhs one row at a time, vectorized over the columns of rhs.
+    # Faster than LAPACK pbtrs for a whole frame of right-hand sides
+    u, n = factor.shape[0] - 1, factor.shape[1]
+    x = np.array(rhs, dtype=np.float32)
+    for j in range(n):
+        for k in range(1, min(u, j) + 1):
+            x[j] -= factor[u - k, j] * x[j - k]
+        x[j] /= factor[u, j]
+    for i in range(n - 1, -1, -1):
+        for k in range(1, min(u, n - 1 - i) + 1):
+            x[i] -= factor[u - k, i + k] * x[i + k]
+        x[i] /= factor[u, i]
+    return x
+
+
+def default_cache_dir() -> str:
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'getfnative', 'weights')
+
+
+# Directory of the on-disk weights cache, None keeps it in memory only
+weights_cache_dir: Optional[str] = default_cache_dir()
+weights_cache_version = 2
+# Size the on-disk weights cache is kept under, in bytes. The least recently used entries are removed first
+weights_cache_limit = 512 * 1024 * 1024
+# Bytes in weights_cache_dir as last counted, None until it's counted
+weights_cache_usage: Optional[int] = None
+weights_cache_lock = threading.Lock()
+# Added to the diagonal of the normal equations, relative to its largest entry
+normal_ridge = 1e-6
+
+
+def prune_weights_cache(directory: str, limit: int) -> int:
+    # Removes the least recently used entries until the cache is under `limit` bytes, and returns its size.
+    # Entries are touched when they're read, so their modification time is the time they were last used
+    entries = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.endswith('.npz'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except OSError:
+        return 0
+
+    usage = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if usage <= limit:
+            break
+        try:
+            os.remove(path)
+            usage -= size
+        except OSError:
+            pass
+    return usage
+
+
+def track_weights_cache(added: int) -> None:
+    # Counts the cache once, then adds up what's written, and prunes it to three quarters of the limit once it's over
+    global weights_cache_usage
+    with weights_cache_lock:
+        if weights_cache_usage is None:
+            weights_cache_usage = prune_weights_cache(weights_cache_dir, weights_cache_limit)
+        else:
+            weights_cache_usage += added
+        if weights_cache_usage > weights_cache_limit:
+            weights_cache_usage = prune_weights_cache(weights_cache_dir, weights_cache_limit * 3 // 4)
+
+
+def factorization_key(kernel: str,
+                      b: int,
+                      c: float,
+                      taps: int,
+                      src_dim: int,
+                      dst_dim: int,
+                      shift: float = 0.0,
+                      active_dim: Optional[float] = None
+                      ) -> tuple:
+    # Parameters a kernel doesn't use are left out, so e.g. every bilinear descale of a geometry shares one entry
+    if active_dim is None:
+        active_dim = src_dim
+    params = {'bicubic': (float(b), float(c)), 'lanczos': (int(taps),)}.get(kernel, ())
+    return (kernel, params, int(src_dim), int(dst_dim), float(shift), float(active_dim))
+
+
+@lru_cache(maxsize=4096)
+def cached_weights(key: tuple) -> tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    # Weights and Cholesky factor of one geometry, from memory, then disk, then computed.
+    # The factor is None if the factorization fails anyway, which is stored as an empty factor on disk
+    kernel, params, src_dim, dst_dim, shift, active_dim = key
+    b, c = params if kernel == 'bicubic' else (0, 1 / 2)
+    taps = params[0] if kernel == 'lanczos' else 3
+
+    path = None
+    if weights_cache_dir is not None:
+        digest = hashlib.sha1(repr((weights_cache_version, key)).encode()).hexdigest()
+        path = os.path.join(weights_cache_dir, f'{kernel}-{src_dim}-{dst_dim}-{digest[:16]}.npz')
+        try:
+            with np.load(path) as cached:
+                idx, w, factor = cached['idx'], cached['w'], cached['factor']
+            os.utime(path)
+            return idx, w, factor if factor.size > 0 else None
+        except (OSError, KeyError, ValueError):
+            pass
+
+    idx, w = scaling_weights(kernel, b, c, taps, src_dim, dst_dim, shift, active_dim)
+    banded = normal_banded(idx, w, src_dim)
+    # Many cropped geometries leave the normal equations (numerically) singular, e.g. edge pixels no output pixel
+    # depends on. A small ridge keeps them positive definite without changing the fit of the well-conditioned ones
+    banded[-1] += normal_ridge * banded[-1].max()
+    try:
+        # Factorized in double precision, applied in single precision like the frames themselves
+        factor = banded_cholesky(banded).astype(np.float32)
+    except np.linalg.LinAlgError:
+        factor = None
+
+    if path is not None:
+        try:
+            os.makedirs(weights_cache_dir, exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                np.savez(f, idx=idx, w=w, factor=factor if factor is not None else np.zeros(0, dtype=np.float32))
+            os.replace(tmp, path)
+            track_weights_cache(os.path.getsize(path))
+        except OSError:
+            pass
+    return idx, w, factor
+
+
+def descale_factorization(kernel: str,
+                          b: int,
+                          c: float,
+                          taps: int,
+                          src_dim: int,
+                          dst_dim: int,
+                          shift: float = 0.0,
+                          active_dim: Optional[float] = None
+                          ) -> tuple:
+    # Upscaling matrix and Cholesky factor of its normal equations, descaling solves weights.T @ weights @ x = weights.T @ y.
+    # The factor is None when the normal equations are singular
+    idx, w, factor = cached_weights(factorization_key(kernel, b, c, taps, src_dim, dst_dim, shift, active_dim))
+    return weights_matrix(idx, w, src_dim), factor
+
+
+def descale_axis(y: np.ndarray, weights, factor: np.ndarray) -> np.ndarray:
+    # Descales along the first axis
+    return banded_solve(factor, weights.T @ y)
+
+
+def numpy_descale_error(frame: np.ndarray,
+                        src_height: float,
+                        base_height: int,
+                        base_width: int,
+                        crop_top: int = 0,
+                        crop_bottom: int = 0,
+                        crop_left: int = 0,
+                        crop_right: int = 0,
+                        kernel: str = 'bicubic',
+                        b: int = 0,
+                        c: float = 1 / 2,
+                        taps: int = 3,
+                        mode: str = 'wh',
+                        thr: float = 0.015
+                        ) -> float:
+    # Same error as descale_error_node, computed in-process on a float frame. Heights that can't be descaled get inf
+    height, width = frame.shape
+    cropping_args = descale_cropping_args(
+        SimpleNamespace(width=width, height=height), src_height, base_height, base_width,
+        crop_top, crop_bottom, crop_left, crop_right, mode)
+
+    frame = frame.astype(np.float32, copy=False)
+    rescaled = frame
+    if 'h' in mode.lower():
+        weights, factor = descale_factorization(
+            kernel, b, c, taps, cropping_args['height'], height, cropping_args['src_top'], cropping_args['src_height'])
+        if factor is None:
+            return float('inf')
+        rescaled = weights @ descale_axis(rescaled, weights, factor)
+    if 'w' in mode.lower():
+        weights, factor = descale_factorization(
+            kernel, b, c, taps, cropping_args['width'], width, cropping_args['src_left'], cropping_args['src_width'])
+        if factor is None:
+            return float('inf')
+        rescaled = (weights @ descale_axis(rescaled.T, weights, factor)).T
+
+    diff = np.abs(frame - rescaled)[10:-10, 10:-10]
+    return float(np.where(diff > thr, diff, 0).mean())
+
+
+def numpy_errors(frames: dict[int, np.ndarray], pairs: list[tuple[int, float]], **kwargs) -> list[float]:
+    # Every (frame, src_height) pair on a thread pool, NumPy releases the GIL in the array operations
+    errors = [0.0] * len(pairs)
+    with ThreadPoolExecutor(max_workers=core.num_threads) as executor:
+        futures = {
+            executor.submit(numpy_descale_error, frames[frame_no], src_height, **kwargs): n
+            for n, (frame_no, src_height) in enumerate(pairs)
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            errors[futures[future]] = future.result()
+            print(f'\r{done}/{len(pairs)}', end='')
+    print()
+    return errors
+
+
+def collect_props(requests: list[tuple[vs.VideoNode, int]],
+                  prop: str = 'PlaneStatsAverage',
+                  window: Optional[int] = None
+                  ) -> list:
+    # Keep up to `window` frames in flight so every core has something to work on
+    if window is None:
+        window = core.num_threads
+    window = max(1, window)
+
+    num_samples = len(requests)
+    values = [None] * num_samples
+    pending = deque()
+    requested = 0
+    done = 0
+    while done < num_samples:
+        while requested < num_samples and len(pending) < window:
+            node, frame_no = requests[requested]
+            pending.append((requested, node.get_frame_async(frame_no)))
+            requested += 1
+        n, future = pending.popleft()
+        with future.result() as f:
+            values[n] = f.props[prop]
+        done += 1
+        print(f'\r{done}/{num_samples}', end='')
+    print()
+    return values
+
+
+def evenly_spaced_frames(clip: vs.VideoNode, count: int) -> list[int]:
+    # Centered in `count` equal parts, so the first and last frames (usually black) are skipped
+    return sorted({floor((i + 0.5) * clip.num_frames / count) for i in range(count)})
+
+
+def scene_frames(clip: vs.VideoNode, count: int) -> list[int]:
+    # Middle frames of `count` scenes spread over the clip, fades and cuts themselves are poor frames to descale
+    small = clip.resize.Bilinear(max(2, clip.width // 4 // 2 * 2), max(2, clip.height // 4 // 2 * 2), format=vs.GRAY8,
+                                 matrix_s='709' if clip.format.color_family == vs.RGB else None)
+    small = core.misc.SCDetect(small)
+    print('Detecting scene changes')
+    changes = collect_props([(small, n) for n in range(clip.num_frames)], '_SceneChangePrev')
+    cuts = [n for n, change in enumerate(changes) if change and n > 0]
+    bounds = list(zip([0] + cuts, cuts + [clip.num_frames]))
+    if len(bounds) <= count:
+        chosen = bounds
+    else:
+        chosen = [bounds[floor((i + 0.5) * len(bounds) / count)] for i in range(count)]
+    return sorted({(start + end - 1) // 2 for start, end in chosen})
+
+
+def aggregate_errors(frame_errors: list[list[float]], method: str = 'median') -> list[float]:
+    errors = np.array(frame_errors, dtype=np.float64)
+    if method == 'median':
+        return np.median(errors, axis=0).tolist()
+    elif method == 'trimmed':
+        # Mean without the lowest and highest fifth of the frames
+        trim = floor(errors.shape[0] * 0.2)
+        errors = np.sort(errors, axis=0)[trim:errors.shape[0] - trim]
+        return errors.mean(axis=0).tolist()
+    elif method == 'mean':
+        return errors.mean(axis=0).tolist()
+    else:
+        raise ValueError('aggregate_errors: invalid method specified.')
+
+
+def plot_errors(src_heights: list[float],
+                errors: list[float],
+                show_plot: bool = True,
+                save_path: Optional[os.PathLike] = None,
+                frame_errors: Optional[dict[int, list[float]]] = None
+                ) -> None:
+    p = plt.figure()
+    plt.close('all')
+    plt.style.use('dark_background')
+    _, ax = plt.subplots(figsize=figaspect(1/2))
+    # Heights that can't be descaled have an inf error, which the log scale can't show
+    errors = np.where(np.isfinite(errors), errors, np.nan)
+    if frame_errors is not None and len(frame_errors) > 1:
+        for frame_no, curve in frame_errors.items():
+            curve = np.where(np.isfinite(curve), curve, np.nan)
+            ax.plot(src_heights, curve, '-', linewidth=0.75, alpha=0.5, label=f'Frame {frame_no}')
+        ax.plot(src_heights, errors, '.w-', linewidth=1, label='Combined')
+        if len(frame_errors) <= 10:
+            ax.legend()
+    else:
+        ax.plot(src_heights, errors, '.w-', linewidth=1)
+    ax.set(xlabel='src_height', ylabel='Error', yscale='log')
+    if save_path is not None:
+        plt.savefig(save_path)
+    if show_plot:
+        plt.show()
+    plt.close(p)
+
+
+def local_minima(errors: dict[int, float]) -> list[int]:
+    # Indices whose error is not above either evaluated neighbour, best first
+    indices = sorted(errors)
+    minima = []
+    for i, n in enumerate(indices):
+        left = errors[indices[i - 1]] if i > 0 else float('inf')
+        right = errors[indices[i + 1]] if i < len(indices) - 1 else float('inf')
+        if errors[n] <= left and errors[n] <= right:
+            minima.append(n)
+    return sorted(minima, key=lambda n: errors[n])
+
+
+def adaptive_search(evaluate: Callable[[list[int]], list[float]],
+                    num_samples: int,
+                    coarse_stride: int
+                    ) -> dict[int, float]:
+    # Scan every `coarse_stride`-th sample, then evaluate every sample between each local minimum and its evaluated
+    # neighbours until the minima settle. Dips narrower than the coarse step can still fall between two coarse samples
+    errors = {}
+    todo = set(range(0, num_samples, coarse_stride)) | {num_samples - 1}
+    while todo:
+        indices = sorted(todo)
+        errors.update(zip(indices, evaluate(indices)))
+        evaluated = sorted(errors)
+        position = {n: i for i, n in enumerate(evaluated)}
+        todo = set()
+        for n in local_minima(errors):
+            i = position[n]
+            todo.update(range(evaluated[max(0, i - 1)] + 1, evaluated[min(len(evaluated) - 1, i + 1)]))
+        todo -= errors.keys()
+    return errors
+
+
 def gen_descale_error(clip: vs.VideoNode,
                       crop_top: int,
                       crop_bottom: int,
                       crop_left: int,
                       crop_right: int,
-                      frame_no: int,
+                      frames: Union[int, Sequence[int]],
                       base_height: int,
                       base_width: int,
                       src_heights: list[float],
@@ -120,50 +595,93 @@ def gen_descale_error(clip: vs.VideoNode,
                       mode: str = 'wh',
                       thr: float = 0.015,
                       show_plot: bool = True,
-                      save_path: Optional[os.PathLike] = None
-                      ) -> None:
-    num_samples = len(src_heights)
-    clips = clip[frame_no].resize.Point(
-        format=vs.GRAYS, matrix_s='709' if clip.format.color_family == vs.RGB else None) * num_samples
-    # Descale
-    scaler = get_scaler(kernel, b, c, taps)
-
-    def _rescale(n: int, clip: vs.VideoNode) -> vs.VideoNode:
-        cropping_args = descale_cropping_args(
-            clip, src_heights[n], base_height, base_width, crop_top, crop_bottom, crop_left, crop_right, mode)
-        descaled = core.descale.Descale(clip, kernel=kernel, b=b, c=c, taps=taps, **cropping_args)
-        cropping_args.update(width=clip.width, height=clip.height)
-        return scaler(descaled, **cropping_args)
-    rescaled = core.std.FrameEval(clips, partial(_rescale, clip=clips))
-    diff = core.std.Expr([clips, rescaled], f'x y - abs dup {thr} > swap 0 ?')
-    diff = diff.std.Crop(10, 10, 10, 10).std.PlaneStats()
+                      save_path: Optional[os.PathLike] = None,
+                      coarse_stride: int = 1,
+                      candidates: int = 5,
+                      aggregate: str = 'median',
+                      engine: str = 'vapoursynth'
+                      ) -> dict[float, float]:
+    if isinstance(frames, int):
+        frames = [frames]
+    frame_clips = {
+        frame_no: clip[frame_no].resize.Point(
+            format=vs.GRAYS, matrix_s='709' if clip.format.color_family == vs.RGB else None)
+        for frame_no in frames
+    }
+    frame_errors = {frame_no: {} for frame_no in frames}
+    if engine == 'numpy':
+        frame_arrays = {frame_no: np.array(frame_clip.get_frame(0)[0], dtype=np.float32)
+                        for frame_no, frame_clip in frame_clips.items()}
+    elif engine != 'vapoursynth':
+        raise ValueError('gen_descale_error: invalid engine specified.')
+
+    def _evaluate(indices: list[int]) -> list[float]:
+        # One flat node per (frame, height) instead of a FrameEval rebuilding the graph for every frame,
+        # all frames go through the same window
+        pairs = [(frame_no, n) for frame_no in frames for n in indices]
+        if engine == 'numpy':
+            errors = numpy_errors(frame_arrays, [(frame_no, src_heights[n]) for frame_no, n in pairs],
+                                  base_height=base_height, base_width=base_width,
+                                  crop_top=crop_top, crop_bottom=crop_bottom, crop_left=crop_left, crop_right=crop_right,
+                                  kernel=kernel, b=b, c=c, taps=taps, mode=mode, thr=thr)
+        else:
+            nodes = [
+                descale_error_node(frame_clips[frame_no], src_heights[n], base_height, base_width,
+                                   crop_top, crop_bottom, crop_left, crop_right, kernel, b, c, taps, mode, thr)
+                for frame_no, n in pairs
+            ]
+            errors = collect_props([(node, 0) for node in nodes])
+        for (frame_no, n), error in zip(pairs, errors):
+            frame_errors[frame_no][n] = error
+        return aggregate_errors([[frame_errors[frame_no][n] for n in indices] for frame_no in frames], aggregate)
+
     # Collect error
-    errors = [0.0] * num_samples
     starttime = time.time()
-    for n, f in enumerate(diff.frames()):
-        print(f'\r{n + 1}/{num_samples}', end='')
-        errors[n] = f.props['PlaneStatsAverage']
-    print(f'\nDone in {time.time() - starttime:.2f}s')
+    if coarse_stride > 1:
+        errors = adaptive_search(_evaluate, len(src_heights), coarse_stride)
+    else:
+        errors = dict(enumerate(_evaluate(list(range(len(src_heights))))))
+    print(f'Done in {time.time() - starttime:.2f}s, {len(errors)}/{len(src_heights)} heights evaluated '
+          f'on {len(frames)} frame{"s" if len(frames) > 1 else ""}')
     gc.collect()
-    # Plot
-    p = plt.figure()
-    plt.close('all')
-    plt.style.use('dark_background')
-    _, ax = plt.subplots(figsize=figaspect(1/2))
-    ax.plot(src_heights, errors, '.w-', linewidth=1)
-    ax.set(xlabel='src_height', ylabel='Error', yscale='log')
-    if save_path is not None:
-        plt.savefig(save_path)
-    if show_plot:
-        plt.show()
-    plt.close(p)
+
+    print('Candidates:')
+    for rank, n in enumerate(local_minima(errors)[:candidates], 1):
+        print(f'{rank:>3}. {src_heights[n]:<10g} {errors[n]:.4e}')
+    if len(frames) > 1:
+        print('Best per frame:')
+        for frame_no, curve in frame_errors.items():
+            n = min(curve, key=curve.get)
+            print(f'{frame_no:>8}: {src_heights[n]:<10g} {curve[n]:.4e}')
+
+    indices = sorted(errors)
+    plot_errors([src_heights[n] for n in indices], [errors[n] for n in indices], show_plot, save_path,
+                {frame_no: [curve[n] for n in indices] for frame_no, curve in frame_errors.items()})
+    return {src_heights[n]: errors[n] for n in indices}
+
+
+def frame_list(value: str) -> list[int]:
+    # --frame 3000 or --frame 3000,4500, a single option value so it can't swallow the positional input
+    try:
+        return [int(frame_no) for frame_no in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid frame list: {value!r}')
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(
         description='Find the native fractional resolution of upscaled material (mostly anime)')
-    parser.add_argument('--frame', '-f', dest='frame_no', type=int,
-                        default=0, help='Specify a frame for the analysis, default is 0')
+    frame_group = parser.add_mutually_exclusive_group()
+    frame_group.add_argument('--frame', '-f', dest='frames', type=frame_list, action='append',
+                        default=None, help='Specify the frame for the analysis, default is 0. '
+                                           'Repeat it or separate frames with commas to use several')
+    frame_group.add_argument('--evenly', '-e', dest='evenly', type=int,
+                        default=None, help='Analyse this many evenly spaced frames')
+    frame_group.add_argument('--scenes', '-s', dest='scenes', type=int,
+                        default=None, help='Analyse the middle frames of this many scenes, needs misc.SCDetect')
+    parser.add_argument('--aggregate', '-ag', dest='aggregate', type=str.lower, default='median',
+                        choices=['median', 'trimmed', 'mean'],
+                        help='How the errors of several frames are combined, trimmed drops the best and worst fifth')
     parser.add_argument('--kernel', '-k', dest='kernel', type=str.lower,
                         default='bicubic', help='Resize kernel to be used')
     parser.add_argument('--bicubic-b', '-b', dest='b', type=to_float,
@@ -190,6 +708,23 @@ def main() -> None:
                         default=None, help='Maximum native src_height to consider')
     parser.add_argument('--step-length', '-sl', dest='sh_step', type=to_float,
                         default='0.25', help='Step length of src_height searching')
+    parser.add_argument('--adaptive', '-a', dest='adaptive', action='store_true',
+                        help='Scan at the coarse step first and only refine around the local minima')
+    parser.add_argument('--coarse-step', '-cs', dest='coarse_step', type=to_float,
+                        default='1', help='Step length of the coarse scan of the adaptive search, default is 1. '
+                                          'Dips narrower than it can be missed')
+    parser.add_argument('--candidates', '-n', dest='candidates', type=int,
+                        default=5, help='Number of local minima to list, default is 5')
+    parser.add_argument('--engine', '-en', dest='engine', type=str.lower, default='vapoursynth',
+                        choices=['vapoursynth', 'numpy'],
+                        help='Descale with the descale plugin, or in-process with NumPy (and SciPy if installed)')
+    parser.add_argument('--cache-dir', dest='cache_dir', type=str, default=None,
+                        help='Directory of the NumPy engine weights cache, default is getfnative/weights in the user cache directory')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='Keep the NumPy engine weights in memory only')
+    parser.add_argument('--cache-size', dest='cache_size', type=int, default=512,
+                        help='Size in MB the weights cache is kept under, the least recently used weights are removed first. '
+                             'Default is 512')
     parser.add_argument('--threshold', '-thr', dest='thr', type=to_float,
                         default='0.015', help='Threshold for calculating descaling error')
     parser.add_argument('--mode', '-m', dest='mode', type=str.lower, default='wh',
@@ -202,6 +737,14 @@ def main() -> None:
                         help='Absolute or relative path to the input VPY script')
     args = parser.parse_args()
 
+    global weights_cache_dir, weights_cache_limit
+    if args.no_cache:
+        weights_cache_dir = None
+    elif args.cache_dir is not None:
+        weights_cache_dir = args.cache_dir
+    assert args.cache_size > 0
+    weights_cache_limit = args.cache_size * 1024 * 1024
+
     ext = os.path.splitext(args.input_file)[1]
     if ext.lower() in {'.py', '.pyw', '.vpy'}:
         clip = vpy_source_filter(args.input_file)
@@ -210,6 +753,18 @@ def main() -> None:
     else:
         raise ValueError('You should provide either a script or an image.')
 
+    if args.evenly is not None:
+        assert args.evenly > 0
+        frames = evenly_spaced_frames(clip, args.evenly)
+    elif args.scenes is not None:
+        assert args.scenes > 0
+        frames = scene_frames(clip, args.scenes)
+    else:
+        frames = list(dict.fromkeys(frame_no for group in args.frames or [[0]] for frame_no in group))
+    assert all(0 <= frame_no < clip.num_frames for frame_no in frames)
+    if len(frames) > 1:
+        print(f'Using frames {", ".join(map(str, frames))}.')
+
     assert args.ct >= 0
     assert args.cb >= 0
     assert args.cl >= 0
@@ -237,7 +792,7 @@ def main() -> None:
     else:
         dir_out = args.save_dir
     save_path = dir_out + os.path.sep + \
-        f'getfnative-f{args.frame_no}-bh{args.bh}'
+        f'getfnative-f{frames[0] if len(frames) == 1 else f"{len(frames)}x"}-bh{args.bh}'
     n = 1
     while True:
         if os.path.exists(save_path + f'-{n}.' + args.save_ext):
@@ -260,10 +815,17 @@ def main() -> None:
     assert sh_min < sh_max - args.sh_step
     max_samples = floor((sh_max - sh_min) / args.sh_step) + 1
     src_heights = [sh_min + n * args.sh_step for n in range(max_samples)]
+    if args.adaptive:
+        assert args.coarse_step >= args.sh_step
+        coarse_stride = round(args.coarse_step / args.sh_step)
+    else:
+        coarse_stride = 1
+    assert args.candidates > 0
 
-    gen_descale_error(clip, args.ct, args.cb, args.cl, args.cr, args.frame_no,
+    gen_descale_error(clip, args.ct, args.cb, args.cl, args.cr, frames,
                       base_height, base_width, src_heights,
-                      args.kernel, args.b, args.c, args.taps, args.mode, args.thr, True, save_path)
+                      args.kernel, args.b, args.c, args.taps, args.mode, args.thr, True, save_path,
+                      coarse_stride, args.candidates, args.aggregate, args.engine)
 
 
 if __name__ == '__main__':